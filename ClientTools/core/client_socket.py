@@ -4,37 +4,88 @@ from loguru import logger
 
 logger = logger.bind(pack="SocketClient")
 
-from CommonTools.core import Socket
+from CommonTools.core import Socket, SendQueue
 from CommonTools.messages import *
 
 
 class WebSocketClient(Socket):
     connected = Signal()
     disconnected = Signal()
+    # Пришёл полный снимок: локальное состояние стола заменяется им
+    state_reset = Signal()
     
-    def __init__(self, max_size=10 * 1024 ** 2):
-        super().__init__(QWebSocket())
+    def __init__(self, max_size=10 * 1024 ** 2, trusted_peers=False, flush_rate: float = 25):
+        super().__init__(QWebSocket(), flush_rate)
         self.socket.setMaxAllowedIncomingMessageSize(max_size)
+        self.client.trusted = trusted_peers
+        self.client.queue = SendQueue(self.socket)
+        # Версия состояния стола, полученная последним снимком/журналом, и запуск сервера;
+        # переживают переподключение, чтобы догнать стол по журналу
+        self.state_version = -1
+        self.state_epoch = ""
         
         self.socket.connected.connect(self.connected.emit)
-        self.socket.disconnected.connect(self.disconnected.emit)
+        self.socket.disconnected.connect(self._handle_disconnected)
         self.socket.textMessageReceived.connect(self._handle_message)
+        self.socket.binaryMessageReceived.connect(self._handle_binary_message)
         self.socket.errorOccurred.connect(self._handle_error)
         
         self.image_sender.client = self.client
+        
+        self.dispatcher.register_many({
+            ClientActionType.CONNECT: self._handle_connect,
+            CommonActionType.BATCH: self._handle_batch,
+            MapActionType.STATE_SNAPSHOT: self._handle_state,
+            MapActionType.STATE_DELTA: self._handle_state,
+        }, "client")
     
     def connect_server(self, ip):
         self.socket.open(QUrl(f"ws://{ip}:8765"))
     
+    def _handle_binary_message(self, message):
+        self._handle_message(message.data())
+    
     def _handle_message(self, message):
-        msg = BaseMessage.from_str(message)
-        if not self.image_receiver.handle_message(msg):
-            match msg.type:
-                case ClientActionType.CONNECT:
-                    self.client.uid = msg.uid
-                    logger.success("Подключен к серверу с uid {uid}", uid=msg.uid)
-                case _:
-                    self.message_received.emit(message)
+        self.enqueue(message)
+    
+    def _handle_connect(self, msg: ClientConnect):
+        self.client.uid = msg.uid
+        self._select_codec(msg.codecs, msg.features)
+        # Прерванные обрывом изображения докачиваются с места обрыва
+        self.image_receiver.resume_pending()
+        logger.success("Подключен к серверу с uid {uid}", uid=msg.uid)
+        return True
+    
+    def _handle_batch(self, msg: BatchMessage):
+        self.dispatcher.dispatch_batch(msg.unpack())
+        return True
+    
+    def _handle_state(self, msg: MapStateSnapshot | MapStateDelta):
+        if msg.type is MapActionType.STATE_SNAPSHOT:
+            self.state_reset.emit()
+        self.dispatcher.dispatch_batch(msg.unpack())
+        self.state_version = msg.version
+        self.state_epoch = msg.epoch
+        return True
+    
+    def _handle_disconnected(self):
+        self.inbound.clear()
+        self.client.queue.clear()
+        self.disconnected.emit()
+    
+    def _select_codec(self, offered: list[str], offered_features: list[str]):
+        # Старый сервер кодеки не предлагает - остаёмся на json5
+        self.client.codec = LEGACY_CODEC
+        self.client.features = frozenset()
+        if not offered:
+            return
+        codec = negotiate_codec(offered)
+        features = negotiate_features(offered_features)
+        # Выбор отправляем ещё старым кодеком, переключаемся только после него
+        self.send_msg(ClientSelectCodec(codec=codec.name, features=sorted(features)))
+        self.client.codec = codec
+        self.client.features = features
+        logger.info("Кодек сообщений: {codec}", codec=codec.name)
     
     def _handle_error(self, error):
         msg_error = f"Ошибка подключения: {error}"
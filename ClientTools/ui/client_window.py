@@ -1,5 +1,6 @@
 from pathlib import Path
 from functools import partial
+from typing import Optional
 
 from PySide6.QtCore import Qt, QTimer
 from PySide6.QtWidgets import QMainWindow, QStackedWidget, QToolBar, QCheckBox, QGraphicsColorizeEffect
@@ -9,11 +10,11 @@ logger = logger.bind(pack="ClientWindow")
 
 
 from ClientTools.core.client_socket import WebSocketClient
-from CommonTools.core import Image
+from CommonTools.core import Image, Tile
 from .connector_widget import Connector
 from .login_widget import Loging
 from .playerController import PlayerController
-from CommonTools.components import GuidePanel, ColorButton, ImageManager, CallbackManager
+from CommonTools.components import GuidePanel, ColorButton, ImageManager, ImageCache, CallbackManager
 from CommonTools.messages import *
 from CommonTools.map_widget.tokens_dnd import MovedEvent
 
@@ -31,16 +32,23 @@ class PlayerGameTable(QMainWindow):
         self.socket.error_occurred.connect(self.showErrorMessage)
         self.socket.connected.connect(self._handle_connect)
         self.socket.disconnected.connect(self._handle_disconnect)
-        self.socket.message_received.connect(self._handle_message_raw)
+        self.socket.state_reset.connect(self._handle_state_reset)
+        self.callback_manager.register_handlers(self.socket.dispatcher)
         self.socket.image_received.connect(self._handle_image)
+        self.socket.tiles_announced.connect(self._handle_tiles_announced)
+        self.socket.tile_received.connect(self._handle_tile)
+        self.socket.image_receiver.session_dropped.connect(self._handle_session_dropped)
         
         self.cache_folder = Path("./.cache")
         self.cache_folder.mkdir(exist_ok=True, parents=True)
+        self.socket.image_receiver.cache_dir = self.cache_folder
+        self.image_cache = ImageCache(self.cache_folder / "images")
         
         self.stacker = QStackedWidget()
         self.setCentralWidget(self.stacker)
         
         self.controller = PlayerController(self.socket)
+        self.controller.tabMaps.tiles_needed.connect(self._request_tiles)
         self.stacker.addWidget(self.controller)
         
         self.connector = Connector(self.socket)
@@ -53,6 +61,12 @@ class PlayerGameTable(QMainWindow):
         
         self.stacker.setCurrentWidget(self.connector)
         
+        self.socket.dispatcher.register_many({
+            ClientActionType.START_PLAYER: self._handle_start_player,
+            MapActionType.LOAD_BACKGROUND: self._handle_load_bg,
+        }, "window")
+        self.socket.dispatcher.set_fallback(self._handle_unhandled, "window")
+        
         self.player_panel = GuidePanel("https://longstoryshort.app/characters/list/", "Лист персонажа", login)
         self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, self.player_panel)
         self.player_panel.hide()
@@ -113,47 +127,92 @@ class PlayerGameTable(QMainWindow):
         self.showErrorMessage("Сервер сдох")
         self.deactivate_controller()
         self.stacker.setCurrentWidget(self.connector)
-        self.controller.tabMaps.clearMaps()
     
-    def _handle_message_raw(self, msg_raw: str):
-        msg = BaseMessage.from_str(msg_raw)
-        self._handle_message(msg)
+    def _handle_state_reset(self):
+        # Стол остаётся на экране до переподключения: журнал доводит его до актуального
+        self.controller.tabMaps.clearMaps()
     
     def _handle_image(self, image: Image):
-        cache_image = self.cache_folder / f"{image.name}{image.suffix}"
-        cache_image.write_bytes(image.image_data)
+        if image.is_preview:
+            self._handle_preview(image)
+            return
+        cache_image = image.file_path
+        if cache_image is None:
+            cache_image = self.cache_folder / f"{image.name}{image.suffix}"
+            cache_image.write_bytes(image.image_data)
         logger.debug("Получено изображение {iname}{isuffix} через {istrategy}", iname=image.name,
                     isuffix=image.suffix, istrategy=image.strategy)
-        self.image_manager.handle(image.name, cache_image)
+        self.image_manager.handle(image.name, cache_image, image)
     
-    def _handle_message(self, msg: BaseMessage):
-        if self.callback_manager.handle(msg):
+    def _handle_preview(self, image: Image):
+        # Полное изображение уже пришло или не запрашивалось
+        if not self.image_manager.is_waiting(image.name):
             return
-        
-        if self.controller.handle_message(msg):
-            return
-        
-        match msg.type:
-            case ClientActionType.START_PLAYER:
-                self.client_data.is_playing = True
-                self.controller.active = True
-                self.activate_controller()
-                self.stacker.setCurrentWidget(self.controller)
-                self.socket.send_msg(GetAllMaps())
-                logger.info("Запуск сессии")
-            case MapActionType.LOAD_BACKGROUND if self.controller.active:
-                self._handle_load_bg(msg)
-            case _:
-                logger.info("Не обработанное сообщение: {mtype} - {msg}", mtype=msg.type, msg=msg)
+        preview = self.cache_folder / f"{image.name}.preview{image.suffix}"
+        preview.write_bytes(image.image_data)
+        logger.debug("Получено превью {iname}", iname=image.name)
+        self.controller.tabMaps.load_preview(image.name, preview, image.preview_of)
+        self.controller.clear_buffer(image.name)
+    
+    def _handle_start_player(self, msg: ClientStartPlayer):
+        self.client_data.is_playing = True
+        self.controller.active = True
+        self.activate_controller()
+        self.stacker.setCurrentWidget(self.controller)
+        self.socket.send_msg(GetAllMaps(version=self.socket.state_version, epoch=self.socket.state_epoch))
+        logger.info("Запуск сессии")
+        return True
+    
+    def _handle_unhandled(self, msg: BaseMessage):
+        logger.info("Не обработанное сообщение: {mtype} - {msg}", mtype=msg.type, msg=msg)
     
     def _handle_load_bg(self, msg: MapLoadBackground):
-        self.image_manager.register(msg.name, self._callback_load_bg)
-        uid = self.callback_manager.register(True, ignore=partial(self.image_manager.unregister, msg.name))
-        self.socket.send_msg(ImageNameRequest(name=msg.name, uid=uid))
+        if not self.controller.active:
+            return
+        if msg.hash and (cached := self.image_cache.get(msg.hash)):
+            logger.debug("Фон {name} взят из кеша", name=msg.name)
+            self._callback_load_bg(msg.name, cached)
+            return True
+        self.image_manager.register(msg.name, partial(self._store_load_bg, msg.hash))
+        # После обрыва фон докачивается прежней сессией: результат получит тот же колбэк
+        if self.socket.image_receiver.is_resuming(msg.name):
+            logger.debug("Фон {name} докачивается", name=msg.name)
+            return True
+        self._request_image(msg.name)
+        return True
+    
+    def _request_image(self, name: str):
+        uid = self.callback_manager.register(True, ignore=partial(self.image_manager.unregister, name))
+        self.socket.send_msg(ImageNameRequest(name=name, uid=uid))
+    
+    def _handle_session_dropped(self, name: str):
+        # Докачка не удалась: фон, который ещё ждут, запрашивается целиком
+        if self.image_manager.is_waiting(name) and not self.socket.image_receiver.is_resuming(name):
+            self._request_image(name)
+    
+    def _handle_tiles_announced(self, msg: ImageTileInfo):
+        # Целиком фон не придёт: тайлы запрашиваются по видимой области
+        self.image_manager.unregister(msg.name)
+        logger.debug("Фон {name} приходит тайлами: {w}x{h}", name=msg.name, w=msg.width, h=msg.height)
+        if self.controller.tabMaps.load_tiled(msg.name, (msg.width, msg.height), msg.tile_size, msg.levels):
+            self.controller.clear_buffer(msg.name)
+    
+    def _handle_tile(self, tile: Tile):
+        self.controller.tabMaps.add_tile(tile.name, tile.level, tile.col, tile.row, tile.data)
+    
+    def _request_tiles(self, name: str, level: int, tiles: list):
+        if tiles:
+            self.socket.send_msg(ImageTileRequest(name=name, level=level, tiles=tiles))
+    
+    def _store_load_bg(self, digest, name, file_path, image: Optional[Image] = None):
+        # Под хешем исходника лежат только его байты: сжатый вариант по быстрому каналу придёт заново
+        if digest and not (image is not None and image.is_degraded):
+            file_path = self.image_cache.put_file(file_path, digest, move=True)
+        self._callback_load_bg(name, file_path, image.full_size if image is not None else (0, 0))
     
-    def _callback_load_bg(self, name, file_path):
+    def _callback_load_bg(self, name, file_path, full_size: tuple[int, int] = (0, 0)):
         self.statusBar().showMessage("Загрузка фона", 2000)
-        self.controller.tabMaps.load_map(name, file_path)
+        self.controller.tabMaps.load_map(name, file_path, full_size)
         self.controller.clear_buffer(name)
         
     def _handle_change_color(self, color):
@@ -16,16 +16,13 @@ class PlayerController(BaseController):
         self.active = False
         self.bufferActive = True
     
-    def _handle_custom_message(self, msg: BaseMessage):
-        match msg.type:
-            case MapActionType.MAP_CREATE:
-                return self._handle_create_map(msg)
-            case MapActionType.MAP_DELETE:
-                return self._handle_delete_map(msg)
-            case MapActionType.MAP_ACTIVE:
-                return self._handle_active_map(msg)
-            case MapActionType.MAP_GRID_DATA:
-                return self._handle_grid_data(msg)
+    def message_routes(self):
+        return super().message_routes() | {
+            MapActionType.MAP_CREATE: self._handle_create_map,
+            MapActionType.MAP_DELETE: self._handle_delete_map,
+            MapActionType.MAP_ACTIVE: self._handle_active_map,
+            MapActionType.MAP_GRID_DATA: self._handle_grid_data,
+        }
     
     def _handle_create_map(self, msg: MapCreateMap):
         return self.tabMaps.addMap(msg.name, msg.visible)
@@ -1,4 +1,5 @@
 from .guide_panel import GuidePanel
 from .colorButton import ColorButton
 from .image_manager import ImageManager
+from .image_cache import ImageCache
 from .callback_manager import CallbackManager
@@ -10,15 +10,12 @@ class CallbackManager:
         self._callback_error: dict[str, Callable] = {}
         self._callback_ignore: dict[str, Callable] = {}
     
-    def handle(self, msg: BaseMessage):
-        match msg.type:
-            case CommonActionType.DONE_CALL:
-                return self._handle_done_call(msg)
-            case CommonActionType.ERROR_CALL:
-                return self._handle_error_call(msg)
-            case CommonActionType.IGNORE_CALL:
-                return self._handle_ignore_call(msg)
-        return False
+    def register_handlers(self, dispatcher):
+        dispatcher.register_many({
+            CommonActionType.DONE_CALL: self._handle_done_call,
+            CommonActionType.ERROR_CALL: self._handle_error_call,
+            CommonActionType.IGNORE_CALL: self._handle_ignore_call,
+        }, "callback")
     
     def register(self, done=None, error=None, ignore=None) -> str:
         uid = uuid.uuid4().hex
@@ -0,0 +1,84 @@
+import os
+import re
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from CommonTools.utils import file_digest
+
+
+class ImageCache:
+    """Кеш изображений по SHA-256 содержимого с вытеснением давно не нужных.
+    
+    Файлы лежат как {hash}{suffix}; порядок использования переживает
+    перезапуск через mtime, поэтому кеш доверяется и после переподключения.
+    """
+    NAME_RE = re.compile(r"^([0-9a-f]{64})(\.[^.]*)?$")
+    
+    def __init__(self, root: Path, max_bytes=1024 ** 3):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+        # hash -> (файл, размер) от давно использованных к свежим
+        self._entries: OrderedDict[str, tuple[Path, int]] = OrderedDict()
+        self._size = 0
+        self._scan()
+    
+    @staticmethod
+    def hash_file(path) -> str:
+        return file_digest(path)
+    
+    def get(self, digest: str) -> Optional[Path]:
+        if digest not in self._entries:
+            return None
+        path, _ = self._entries[digest]
+        if not path.exists():
+            self._forget(digest)
+            return None
+        self._entries.move_to_end(digest)
+        os.utime(path)
+        return path
+    
+    def put_file(self, path, digest: Optional[str] = None, move=False) -> Path:
+        """Положить файл в кеш под digest (по умолчанию - хеш его байт)"""
+        path = Path(path)
+        digest = digest or self.hash_file(path)
+        if (cached := self.get(digest)) is not None:
+            if move:
+                path.unlink(missing_ok=True)
+            return cached
+        target = self.root / f"{digest}{path.suffix}"
+        if move:
+            os.replace(path, target)
+        else:
+            shutil.copyfile(path, target)
+        size = target.stat().st_size
+        self._entries[digest] = (target, size)
+        self._size += size
+        self._evict(keep=digest)
+        return target
+    
+    def _scan(self):
+        found = []
+        for path in self.root.iterdir():
+            if path.is_file() and (match := self.NAME_RE.match(path.name)):
+                stat = path.stat()
+                found.append((stat.st_mtime, match.group(1), path, stat.st_size))
+        for _, digest, path, size in sorted(found):
+            self._entries[digest] = (path, size)
+            self._size += size
+        self._evict()
+    
+    def _evict(self, keep: Optional[str] = None):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            digest = next(iter(self._entries))
+            if digest == keep:
+                break
+            path = self._forget(digest)
+            path.unlink(missing_ok=True)
+    
+    def _forget(self, digest: str) -> Path:
+        path, size = self._entries.pop(digest)
+        self._size -= size
+        return path
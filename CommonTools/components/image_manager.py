@@ -8,6 +8,9 @@ class ImageManager:
     def unregister(self, name):
         self._callbacks.pop(name, None)
         
-    def handle(self, name, file_path):
+    def is_waiting(self, name):
+        return name in self._callbacks
+    
+    def handle(self, name, file_path, *args):
         if impl := self._callbacks.pop(name, None):
-            impl(name, file_path)
\ No newline at end of file
+            impl(name, file_path, *args)
\ No newline at end of file
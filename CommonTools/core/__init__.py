@@ -1,4 +1,11 @@
+from .send_queue import SendQueue
 from .client_data import ClientData
+from .frame_stats import FrameStats
+from .dispatcher import MessageDispatcher
+from .outbound import OutboundCoalescer
 from .socket import Socket
-from .image_receiver import ImageReceiver, Image
+from .image_receiver import ImageReceiver, Image, Tile
+from .chunk_job import ChunkJob
+from .image_service import ImageService
+from .payload_cache import PayloadCache, EncodedPayload
 from .image_sender import ImageSender
@@ -0,0 +1,111 @@
+import base64
+import math
+from collections import deque
+from typing import BinaryIO, Iterable, Optional
+
+from PySide6.QtCore import QObject, Signal
+
+from CommonTools.messages import *
+from .client_data import ClientData
+
+
+class ChunkJob(QObject):
+    """Потоковая отправка изображения кусками.
+    
+    Кусок читается и кодируется только перед отправкой. В очереди сокета
+    одновременно лежит не больше window кусков; окно пополняется, когда
+    очередь их отдаёт в сеть, поэтому память ограничена окном, а не файлом.
+    indexes - только эти куски (докачка после обрыва).
+    """
+    progress = Signal(str, int)
+    finished = Signal(str)
+    cancelled = Signal(str)
+    
+    def __init__(self, session_id: str, name: str, suffix: str, quality: int,
+                 source: BinaryIO, total_size: int, client: ClientData,
+                 chunk_size=48 * 1024, window=8, stream=-1, indexes: Optional[Iterable[int]] = None,
+                 full_size: tuple[int, int] = (0, 0)):
+        super().__init__()
+        self.session_id = session_id
+        self.name = name
+        self.suffix = suffix
+        self.quality = quality
+        self.source = source
+        self.total_size = total_size
+        self.client = client
+        # Кратно 3: каждый кусок в base64 декодируется отдельно
+        self.chunk_size = chunk_size - chunk_size % 3
+        self.window = window
+        # >= 0: куски идут бинарными кадрами этого потока
+        self.stream = stream
+        # Размер исходника, если картинка уменьшена при сжатии
+        self.full_size = full_size
+        
+        self.total_chunks = max(1, math.ceil(total_size / self.chunk_size))
+        self.pending = deque(range(self.total_chunks) if indexes is None else indexes)
+        self.to_send = len(self.pending)
+        self.active = False
+        self._filling = False
+    
+    def start(self):
+        self.active = True
+        self.client.send_msg(ImageSendChunkStart(
+            session_id=self.session_id,
+            name=self.name,
+            total_chunks=self.total_chunks,
+            total_size=self.total_size,
+            quality=self.quality,
+            chunk_size=self.chunk_size,
+            suffix=self.suffix,
+            stream=self.stream,
+            full_size=self.full_size
+        ))
+        if queue := self.client.queue:
+            queue.bulk_sent.connect(self.fill)
+        self.client.socket.bytesWritten.connect(self.fill)
+        self.client.socket.disconnected.connect(self.cancel)
+        self.fill()
+    
+    def fill(self, *_):
+        """Дослать куски до заполнения окна"""
+        if not self.active or self._filling:
+            return
+        self._filling = True
+        try:
+            while self.active and self.pending and self._in_flight() < self.window:
+                self._send_chunk(self.pending.popleft())
+                sent = self.to_send - len(self.pending)
+                self.progress.emit(self.session_id, sent * 100 // max(1, self.to_send))
+            if self.active and not self.pending:
+                self.client.send_msg(ImageSendChunkEnd(session_id=self.session_id))
+                self._stop()
+                self.finished.emit(self.session_id)
+        finally:
+            self._filling = False
+    
+    def cancel(self):
+        if self.active:
+            self._stop()
+            self.cancelled.emit(self.session_id)
+    
+    def _send_chunk(self, index: int):
+        self.source.seek(index * self.chunk_size)
+        chunk = self.source.read(self.chunk_size)
+        if self.stream >= 0:
+            self.client.send_frame(ImageFrame.build(ImageFrameKind.CHUNK, self.stream, index, chunk), bulk=True)
+            return
+        self.client.send_msg(ImageSendChunk(
+            session_id=self.session_id,
+            chunk_index=index,
+            data=base64.b64encode(chunk).decode("utf-8")
+        ))
+    
+    def _in_flight(self) -> int:
+        return self.client.queue.bulk_depth if self.client.queue else 0
+    
+    def _stop(self):
+        self.active = False
+        if queue := self.client.queue:
+            queue.bulk_sent.disconnect(self.fill)
+        self.client.socket.bytesWritten.disconnect(self.fill)
+        self.client.socket.disconnected.disconnect(self.cancel)
@@ -1,10 +1,10 @@
-from typing import Optional
+from typing import Optional, Hashable
 
 from PySide6.QtWebSockets import QWebSocket
 from attrs import define, field
-import json5
 
-from CommonTools.messages import BaseMessage
+from CommonTools.messages import BaseMessage, Codec, LEGACY_CODEC
+from .send_queue import SendQueue
 
 
 @define
@@ -16,9 +16,32 @@ class ClientData:
     socket: Optional[QWebSocket] = field(repr=False)
     
     is_playing: bool = field(default=False, init=False)
+    codec: Codec = field(default=LEGACY_CODEC, init=False)
+    # Согласованные возможности протокола (BINARY_IMAGES и т.п.)
+    features: frozenset[str] = field(factory=frozenset, init=False)
+    # Доверенный собеседник: исходящие сообщения кодируются без сериализатора pydantic
+    # (to_dict(trusted=True)); входящие проверяются всегда
+    trusted: bool = field(default=False, init=False)
+    # Версия состояния стола, до которой клиент синхронизирован (-1 - ещё нет)
+    state_version: int = field(default=-1, init=False)
+    # Очередь с обратным давлением; без неё кадры уходят в сокет напрямую
+    queue: Optional[SendQueue] = field(default=None, init=False, repr=False)
+    
+    def encode(self, msg: BaseMessage) -> str | bytes:
+        return self.codec.encode(msg.to_dict(self.trusted))
     
     def send_msg(self, msg: BaseMessage):
-        self.send_str(msg.to_dict())
+        self.send_frame(self.encode(msg), bulk=msg.bulk)
     
     def send_str(self, msg: dict):
-        self.socket.sendTextMessage(json5.dumps(msg, ensure_ascii=False))
+        self.send_frame(self.codec.encode(msg))
+    
+    def send_frame(self, frame: str | bytes, key: Optional[Hashable] = None, bulk=False):
+        """key - ключ вытесняемого обновления состояния, None - управляющий кадр;
+        bulk - кадр массовой полосы (изображения)"""
+        if self.queue is not None:
+            self.queue.push(frame, key, bulk)
+        elif isinstance(frame, str):
+            self.socket.sendTextMessage(frame)
+        else:
+            self.socket.sendBinaryMessage(frame)
@@ -0,0 +1,117 @@
+import time
+from contextlib import contextmanager, ExitStack
+from typing import Callable, Any, Optional, ContextManager
+
+from attrs import define, field
+
+from CommonTools.messages import BaseMessage, BaseActionType
+
+
+@define
+class HandlerTiming:
+    calls: int = field(default=0)
+    total: float = field(default=0.0)
+    worst: float = field(default=0.0)
+    
+    def add(self, elapsed: float):
+        self.calls += 1
+        self.total += elapsed
+        self.worst = max(self.worst, elapsed)
+    
+    @property
+    def average(self):
+        return self.total / self.calls if self.calls else 0.0
+
+
+@define
+class Route:
+    handler: Callable[..., Any]
+    subsystem: str
+    context: bool
+
+
+class MessageDispatcher:
+    """Единая таблица маршрутов: тип действия -> подписанные обработчики.
+    
+    Обработчики одного типа вызываются в порядке регистрации, пока кто-то
+    не вернёт истину. Обработчики с context=True получают контекст кадра
+    (на сервере - uid клиента) перед сообщением.
+    """
+    
+    def __init__(self):
+        self._routes: dict[BaseActionType, list[Route]] = {}
+        self._fallback: Optional[Route] = None
+        
+        self._batch_scopes: list[Callable[[], ContextManager]] = []
+        self._batch_depth = 0
+        
+        self.timing_enabled = False
+        self.timings: dict[BaseActionType, HandlerTiming] = {}
+    
+    def register(self, action: BaseActionType, handler: Callable, subsystem: str = "", context=False):
+        self._routes.setdefault(action, []).append(Route(handler, subsystem, context))
+    
+    def register_many(self, routes: dict[BaseActionType, Callable], subsystem: str = "", context=False):
+        for action, handler in routes.items():
+            self.register(action, handler, subsystem, context)
+    
+    def unregister(self, subsystem: str):
+        for action, routes in self._routes.items():
+            routes[:] = [route for route in routes if route.subsystem != subsystem]
+        if self._fallback and self._fallback.subsystem == subsystem:
+            self._fallback = None
+    
+    def set_fallback(self, handler: Callable, subsystem: str = "", context=False):
+        """Обработчик для сообщений, которые никто не принял"""
+        self._fallback = Route(handler, subsystem, context)
+    
+    def handlers(self, action: BaseActionType) -> list[Route]:
+        return list(self._routes.get(action, ()))
+    
+    def dispatch(self, msg: BaseMessage, *context) -> bool:
+        started = time.perf_counter() if self.timing_enabled else 0.0
+        try:
+            for route in self._routes.get(msg.type, ()):
+                if route.handler(*context, msg) if route.context else route.handler(msg):
+                    return True
+            if route := self._fallback:
+                route.handler(*context, msg) if route.context else route.handler(msg)
+            return False
+        finally:
+            if self.timing_enabled:
+                self.timings.setdefault(msg.type, HandlerTiming()).add(time.perf_counter() - started)
+    
+    def add_batch_scope(self, factory: Callable[[], ContextManager]):
+        """Контекст, в который оборачивается применение пачки сообщений"""
+        self._batch_scopes.append(factory)
+    
+    @contextmanager
+    def batch(self):
+        """Одна транзакция на пачку: вложенные пачки входят во внешнюю"""
+        if self._batch_depth:
+            yield
+            return
+        with ExitStack() as stack:
+            for factory in self._batch_scopes:
+                stack.enter_context(factory())
+            self._batch_depth += 1
+            try:
+                yield
+            finally:
+                self._batch_depth -= 1
+    
+    def dispatch_batch(self, messages: list[BaseMessage], *context):
+        with self.batch():
+            for msg in messages:
+                self.dispatch(msg, *context)
+    
+    def enable_timing(self, enabled=True):
+        self.timing_enabled = enabled
+        if enabled:
+            self.timings.clear()
+    
+    def report(self) -> list[tuple[str, int, float, float]]:
+        """(тип, вызовы, среднее мс, худшее мс) по убыванию суммарного времени"""
+        rows = sorted(self.timings.items(), key=lambda item: item[1].total, reverse=True)
+        return [(str(action), timing.calls, timing.average * 1e3, timing.worst * 1e3)
+                for action, timing in rows]
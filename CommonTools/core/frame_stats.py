@@ -0,0 +1,34 @@
+import time
+
+from attrs import define, field
+
+
+@define
+class FrameStats:
+    """Счётчики разбора входящих кадров"""
+    decoded: int = field(default=0)
+    decodes_saved: int = field(default=0)
+    superseded: int = field(default=0)
+    started: float = field(factory=time.perf_counter)
+    
+    def frame_decoded(self):
+        self.decoded += 1
+    
+    def frame_delivered(self):
+        """Готовый объект ушёл обработчикам вместо повторного разбора строки"""
+        self.decodes_saved += 1
+    
+    def frame_superseded(self):
+        """Кадр перекрыт более поздним в той же пачке и не применялся"""
+        self.superseded += 1
+    
+    def reset(self):
+        self.decoded = 0
+        self.decodes_saved = 0
+        self.superseded = 0
+        self.started = time.perf_counter()
+    
+    def rates(self) -> tuple[float, float]:
+        """Разобрано и сэкономлено разборов в секунду"""
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return self.decoded / elapsed, self.decodes_saved / elapsed
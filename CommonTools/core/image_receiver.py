@@ -1,18 +1,90 @@
 import base64
+import mmap
+import os
+import time
+from functools import partial
+from pathlib import Path
 from typing import Optional
 
 from attrs import define, field
-from PySide6.QtCore import QObject, Signal
+from PySide6.QtCore import QObject, Signal, QTimer
+from loguru import logger
+
+logger = logger.bind(pack="ImageReceiver")
 
 from CommonTools.messages import *
 
 
 @define
 class Image:
-    image_data: bytes
+    image_data: bytes | bytearray
     strategy: str
     name: str
     suffix: str
+    # Уже записано на диск: image_data пустые, файл готов к загрузке
+    file_path: Optional[Path] = field(default=None)
+    # Превью: размер полного изображения, которое придёт следом
+    preview_of: tuple[int, int] = field(default=(0, 0))
+    # 100 - байты исходника без потерь
+    quality: int = field(default=100)
+    # Картинка уменьшена при сжатии: размер исходника, в котором её показывать
+    full_size: tuple[int, int] = field(default=(0, 0))
+    
+    @property
+    def is_preview(self):
+        return self.preview_of != (0, 0)
+    
+    @property
+    def is_degraded(self):
+        """Байты отличаются от исходника: сжаты с потерями или уменьшены"""
+        return self.quality < 100 or self.full_size != (0, 0)
+
+
+@define
+class Tile:
+    name: str
+    level: int
+    col: int
+    row: int
+    data: bytes = field(repr=False)
+
+
+class PartFile:
+    """Файл-приёмник сессии: куски пишутся по своему смещению в .part,
+    по завершении файл переименовывается в итоговое имя.
+    
+    .part свой у каждой сессии: параллельные сессии одного фона
+    (докачка и новый запрос, два отправителя) не затирают друг друга.
+    """
+    
+    def __init__(self, path: Path, part: Path, size: int, use_mmap=False):
+        self.path = path
+        self.part = part
+        self.file = open(self.part, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size) if use_mmap and size else None
+    
+    def write(self, offset: int, data):
+        if self.map is not None:
+            self.map[offset:offset + len(data)] = data
+        else:
+            self.file.seek(offset)
+            self.file.write(data)
+    
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+    
+    def commit(self) -> Path:
+        self.close()
+        os.replace(self.part, self.path)
+        return self.path
+    
+    def discard(self):
+        self.close()
+        self.part.unlink(missing_ok=True)
 
 
 @define
@@ -23,46 +95,133 @@ class SessionChunk:
     name: str
     suffix: str
     
+    session_id: str = field(default="")
+    strategy: str = field(default="chunks")
+    # Бинарные кадры пишутся сразу в буфер на весь файл, текстовые - списком
+    binary: bool = field(default=False)
+    # Бинарная сессия с диском: куски сразу в файл, без буфера в памяти
+    file: Optional[PartFile] = field(default=None, repr=False)
+    preview_of: tuple[int, int] = field(default=(0, 0))
+    quality: int = field(default=100)
+    full_size: tuple[int, int] = field(default=(0, 0))
+    
     received_chunks: int = field(default=0)
+    # Карта полученных кусков: 1 - кусок на месте
+    received: bytearray = field(init=False)
     chunks: list[Optional[bytes]] = field(init=False)
+    buffer: Optional[bytearray] = field(init=False, default=None)
+    touched: float = field(factory=time.monotonic)
     
     def __attrs_post_init__(self):
-        self.chunks = [None] * self.total_chunks
+        self.received = bytearray(self.total_chunks)
+        if self.binary:
+            self.chunks = []
+            if self.file is None:
+                self.buffer = bytearray(self.total_size)
+        else:
+            self.chunks = [None] * self.total_chunks
+    
+    def mark(self, index: int) -> bool:
+        """Отметить кусок; False - такой уже был (повторная отправка)"""
+        # Отрицательный номер попал бы в чужой кусок с конца
+        if not 0 <= index < self.total_chunks:
+            raise ValueError(f"chunk {index} is out of image bounds")
+        self.touched = time.monotonic()
+        if self.received[index]:
+            return False
+        self.received[index] = 1
+        self.received_chunks += 1
+        return True
+    
+    def missing(self) -> list[int]:
+        return [index for index, flag in enumerate(self.received) if not flag]
+    
+    @property
+    def complete(self):
+        return self.received_chunks >= self.total_chunks
+    
+    def write(self, offset: int, data):
+        if self.file is not None:
+            self.file.write(offset, data)
+        else:
+            self.buffer[offset:offset + len(data)] = data
+    
+    def payload(self) -> bytes | bytearray:
+        if self.file is not None:
+            return b""
+        return self.buffer if self.binary else b"".join(self.chunks)
+    
+    def discard(self):
+        if self.file is not None:
+            self.file.discard()
 
 
 class ImageReceiver(QObject):
     image_received = Signal(object)
     chunk_progress = Signal(str, int)
+    # Фон будет приходить тайлами (ImageTileInfo) и сами тайлы (Tile)
+    tiles_announced = Signal(object)
+    tile_received = Signal(object)
+    # Служебный ответ отправителю: (отправитель, сообщение)
+    reply = Signal(str, object)
+    # Незавершённая сессия потеряна (отменена или истекла): изображение нужно запросить заново
+    session_dropped = Signal(str)
     
     error_occurred = Signal(str)
     
-    def __init__(self):
+    def __init__(self, max_session_size=128 * 1024 ** 2, session_ttl=300, ack_every=16,
+                 cache_dir: Optional[Path] = None, use_mmap=False):
         super().__init__()
-        self.active_sessions: dict[str, SessionChunk] = {}
-    
-    # noinspection PyTypeChecker
-    def handle_message(self, msg: BaseMessage):
-        match msg.type:
-            case ImageActionType.SEND_DIRECT:
-                return self._handle_direct(msg)
-            case ImageActionType.SEND_COMPRESS:
-                return self._handle_compressed(msg)
-            case ImageActionType.SEND_CHUNK_START:
-                return self._handle_chunk_start(msg)
-            case ImageActionType.SEND_CHUNK:
-                return self._handle_chunk(msg)
-            case ImageActionType.SEND_CHUNK_END:
-                return self._handle_chunk_end(msg)
-        return False
-    
-    def _handle_direct(self, msg: ImageSendDirect):
+        # Ключи с отправителем: у разных клиентов номера сессий и потоков свои
+        self.active_sessions: dict[tuple[str, str], SessionChunk] = {}
+        self.streams: dict[tuple[str, int], SessionChunk] = {}
+        # Поток бинарных тайлов -> имя фона
+        self.tile_streams: dict[tuple[str, int], str] = {}
+        
+        self.max_session_size = max_session_size
+        self.session_ttl = session_ttl
+        self.ack_every = ack_every
+        # Куда писать бинарные сессии кусками; None - собирать в памяти
+        self.cache_dir = cache_dir
+        self.use_mmap = use_mmap
+        
+        self.expire_timer = QTimer(self)
+        self.expire_timer.setInterval(30 * 1000)
+        self.expire_timer.timeout.connect(self.expire_sessions)
+        self.expire_timer.start()
+    
+    def register_handlers(self, dispatcher, peer_context=False):
+        """peer_context - диспетчер передаёт отправителя перед сообщением"""
+        routes = {
+            ImageActionType.SEND_DIRECT: self._handle_direct,
+            ImageActionType.SEND_COMPRESS: self._handle_compressed,
+            ImageActionType.SEND_CHUNK_START: self._handle_chunk_start,
+            ImageActionType.SEND_CHUNK: self._handle_chunk,
+            ImageActionType.SEND_CHUNK_END: self._handle_chunk_end,
+            ImageActionType.SEND_CHUNK_RAW: self._handle_frame,
+            ImageActionType.CHUNK_CANCEL: self._handle_cancel,
+            ImageActionType.TILE_INFO: self._handle_tile_info,
+            ImageActionType.SEND_TILE: self._handle_tile,
+        }
+        if not peer_context:
+            routes = {action: partial(handler, "") for action, handler in routes.items()}
+        dispatcher.register_many(routes, "image", context=peer_context)
+    
+    def _handle_direct(self, peer: str, msg: ImageSendDirect):
         try:
+            if msg.stream >= 0:
+                self._check_size(msg.size)
+                self.streams[(peer, msg.stream)] = SessionChunk(
+                    1, msg.size, msg.size, msg.name, msg.suffix, strategy="direct", binary=True,
+                    full_size=tuple(msg.full_size))
+                return True
             image_data = base64.b64decode(msg.data.encode("utf-8"))
             self.image_received.emit(Image(
                 image_data,
                 "direct",
                 msg.name,
-                msg.suffix
+                msg.suffix,
+                full_size=tuple(msg.full_size)
             ))
             return True
         except Exception as e:
@@ -70,14 +229,23 @@ class ImageReceiver(QObject):
             self.error_occurred.emit(msg_error)
             return False
     
-    def _handle_compressed(self, msg: ImageSendCompress):
+    def _handle_compressed(self, peer: str, msg: ImageSendCompress):
         try:
+            if msg.stream >= 0:
+                self._check_size(msg.csize)
+                self.streams[(peer, msg.stream)] = SessionChunk(
+                    1, msg.csize, msg.csize, msg.name, msg.suffix, strategy="compress", binary=True,
+                    preview_of=tuple(msg.preview_of), quality=msg.quality, full_size=tuple(msg.full_size))
+                return True
             image_data = base64.b64decode(msg.data.encode("utf-8"))
             self.image_received.emit(Image(
                 image_data,
                 "compress",
                 msg.name,
-                msg.suffix
+                msg.suffix,
+                preview_of=tuple(msg.preview_of),
+                quality=msg.quality,
+                full_size=tuple(msg.full_size)
             ))
             return True
         except Exception as e:
@@ -85,62 +253,182 @@ class ImageReceiver(QObject):
             self.error_occurred.emit(msg_error)
             return False
     
-    def _handle_chunk_start(self, msg: ImageSendChunkStart):
+    def _handle_chunk_start(self, peer: str, msg: ImageSendChunkStart):
         try:
             suid = msg.session_id
-            self.active_sessions[suid] = SessionChunk(
-                msg.total_chunks,
-                msg.total_size,
-                msg.chunk_size,
-                msg.name,
-                msg.suffix
-            )
-            print(f"Start chunked {suid}: {msg.total_chunks}")
+            session = self.active_sessions.get((peer, suid))
+            # Повторный старт той же сессии - докачка: полученное сохраняется
+            if session is None or (session.total_size, session.total_chunks, session.binary) != (
+                    msg.total_size, msg.total_chunks, msg.stream >= 0):
+                self._check_size(msg.total_size)
+                self._drop_session(peer, suid)
+                binary = msg.stream >= 0
+                session = self.active_sessions[(peer, suid)] = SessionChunk(
+                    msg.total_chunks,
+                    msg.total_size,
+                    msg.chunk_size,
+                    msg.name,
+                    msg.suffix,
+                    session_id=suid,
+                    binary=binary,
+                    quality=msg.quality,
+                    full_size=tuple(msg.full_size),
+                    file=self._part_file(peer, suid, msg.name, msg.suffix, msg.total_size) if binary else None
+                )
+            if session.binary:
+                self.streams[(peer, msg.stream)] = session
+            logger.debug("Начата сессия {suid}: {total} кусков", suid=suid, total=msg.total_chunks)
             return True
         except Exception as e:
             msg_error = f"Error: {e}"
             self.error_occurred.emit(msg_error)
             return False
     
-    def _handle_chunk(self, msg: ImageSendChunk):
+    def _handle_chunk(self, peer: str, msg: ImageSendChunk):
         try:
             suid = msg.session_id
-            if suid not in self.active_sessions:
-                print("Session uid not find")
+            if (peer, suid) not in self.active_sessions:
+                logger.warning("Кусок неизвестной сессии {suid}", suid=suid)
                 return
-            session = self.active_sessions[suid]
-            print(f"chunked {suid}")
+            session = self.active_sessions[(peer, suid)]
             idx = msg.chunk_index
             
-            session.chunks[idx] = base64.b64decode(msg.data.encode("utf-8"))
-            session.received_chunks += 1
+            if session.mark(idx):
+                session.chunks[idx] = base64.b64decode(msg.data.encode("utf-8"))
+                self._chunk_received(peer, session)
+            return True
+        except Exception as e:
+            msg_error = f"Error: {e}"
+            self.error_occurred.emit(msg_error)
+            return False
+    
+    def _handle_frame(self, peer: str, frame: ImageFrame):
+        try:
+            if frame.kind == ImageFrameKind.TILE:
+                if (name := self.tile_streams.get((peer, frame.stream))) is not None:
+                    self.tile_received.emit(Tile(name, *frame.tile(), bytes(frame.payload)))
+                return True
+            session = self.streams.get((peer, frame.stream))
+            if session is None:
+                logger.warning("Кадр неизвестного потока {stream}", stream=frame.stream)
+                return True
+            offset = frame.index * session.chunk_size
+            end = offset + len(frame.payload)
+            if end > session.total_size:
+                raise ValueError(f"chunk {frame.index} is out of image bounds")
+            if not session.mark(frame.index):
+                return True
+            session.write(offset, frame.payload)
             
-            pp = (session.received_chunks / session.total_chunks * 100)
-            self.chunk_progress.emit(suid, pp)
+            if session.strategy != "chunks":
+                del self.streams[(peer, frame.stream)]
+                self.image_received.emit(Image(
+                    session.payload(),
+                    session.strategy,
+                    session.name,
+                    session.suffix,
+                    preview_of=session.preview_of,
+                    quality=session.quality,
+                    full_size=session.full_size
+                ))
+            else:
+                self._chunk_received(peer, session)
             return True
         except Exception as e:
             msg_error = f"Error: {e}"
             self.error_occurred.emit(msg_error)
             return False
-        
-    def _handle_chunk_end(self, msg: ImageSendChunkEnd):
+    
+    def _handle_chunk_end(self, peer: str, msg: ImageSendChunkEnd):
         try:
             suid = msg.session_id
-            if suid not in self.active_sessions:
-                print("Session uid not find")
+            if (peer, suid) not in self.active_sessions:
+                logger.warning("Конец неизвестной сессии {suid}", suid=suid)
                 return
-            print(f"End chunked {suid}")
-            session = self.active_sessions[suid]
-            image_data = b"".join(session.chunks)
+            logger.debug("Завершена сессия {suid}", suid=suid)
+            session = self.active_sessions[(peer, suid)]
+            if not session.complete:
+                # Часть кусков потерялась - просим только их
+                self.reply.emit(peer, ImageResumeRequest(session_id=suid, missing=session.missing()))
+                return True
+            self.active_sessions.pop((peer, suid))
+            self.streams = {key: stream for key, stream in self.streams.items() if stream is not session}
+            self.reply.emit(peer, ImageChunkAck(session_id=suid, received=session.received_chunks, complete=True))
             
             self.image_received.emit(Image(
-                image_data,
+                session.payload(),
                 "chunks",
                 session.name,
-                session.suffix
+                session.suffix,
+                session.file.commit() if session.file is not None else None,
+                quality=session.quality,
+                full_size=session.full_size
             ))
             return True
         except Exception as e:
             msg_error = f"Error: {e}"
             self.error_occurred.emit(msg_error)
-            return False
\ No newline at end of file
+            return False
+    
+    def _handle_tile_info(self, peer: str, msg: ImageTileInfo):
+        if msg.stream >= 0:
+            self.tile_streams[(peer, msg.stream)] = msg.name
+        self.tiles_announced.emit(msg)
+        return True
+    
+    def _handle_tile(self, peer: str, msg: ImageSendTile):
+        try:
+            self.tile_received.emit(Tile(msg.name, msg.level, msg.col, msg.row,
+                                         base64.b64decode(msg.data.encode("utf-8"))))
+            return True
+        except Exception as e:
+            msg_error = f"Error: {e}"
+            self.error_occurred.emit(msg_error)
+            return False
+    
+    def _handle_cancel(self, peer: str, msg: ImageChunkCancel):
+        if (session := self.active_sessions.get((peer, msg.session_id))) is not None:
+            self._drop_session(peer, msg.session_id)
+            self.session_dropped.emit(session.name)
+        return True
+    
+    def is_resuming(self, name: str, peer: str = "") -> bool:
+        """Изображение докачивается незавершённой сессией: новый запрос не нужен"""
+        return any(session_peer == peer and session.name == name and not session.complete
+                   for (session_peer, _), session in self.active_sessions.items())
+    
+    def resume_pending(self, peer: str = ""):
+        """После переподключения запросить недостающие куски всех сессий"""
+        for (session_peer, suid), session in list(self.active_sessions.items()):
+            if session_peer == peer and not session.complete:
+                self.reply.emit(peer, ImageResumeRequest(session_id=suid, missing=session.missing()))
+    
+    def expire_sessions(self):
+        """Забыть сессии, в которые давно ничего не приходило"""
+        deadline = time.monotonic() - self.session_ttl
+        for key, session in list(self.active_sessions.items()):
+            if session.touched < deadline:
+                self._drop_session(*key)
+                self.session_dropped.emit(session.name)
+        self.streams = {key: stream for key, stream in self.streams.items() if stream.touched >= deadline}
+    
+    def _chunk_received(self, peer: str, session: SessionChunk):
+        pp = (session.received_chunks / session.total_chunks * 100)
+        self.chunk_progress.emit(session.session_id, pp)
+        if session.received_chunks % self.ack_every == 0:
+            self.reply.emit(peer, ImageChunkAck(session_id=session.session_id, received=session.received_chunks))
+    
+    def _drop_session(self, peer: str, suid: str):
+        if (session := self.active_sessions.pop((peer, suid), None)) is not None:
+            self.streams = {key: stream for key, stream in self.streams.items() if stream is not session}
+            session.discard()
+    
+    def _part_file(self, peer: str, suid: str, name: str, suffix: str, size: int) -> Optional[PartFile]:
+        if self.cache_dir is None:
+            return None
+        part = Path(f"{peer or 'server'}-{suid}.part").name
+        return PartFile(self.cache_dir / Path(f"{name}{suffix}").name, self.cache_dir / part, size, self.use_mmap)
+    
+    def _check_size(self, size: int):
+        if size > self.max_session_size:
+            raise ValueError(f"image of {size} bytes exceeds the {self.max_session_size} bytes limit")
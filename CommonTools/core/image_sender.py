@@ -1,27 +1,99 @@
 import base64
+import io
+import itertools
+import math
 import os
-from typing import Optional
+import uuid
+from typing import Optional, Callable, Iterable
 from contextlib import contextmanager
+from functools import partial
 import time
-from pathlib import Path
 
 
-from PySide6.QtCore import QObject, Signal
-from PySide6.QtWidgets import QApplication
+from attrs import define, field
+from PySide6.QtCore import QObject, Signal, QTimer
 
-from CommonTools.utils import compress_image_to_base64
 from CommonTools.messages import *
 from .client_data import ClientData
+from .chunk_job import ChunkJob
+from .image_service import ImageService
+from .payload_cache import PayloadCache, EncodedPayload
+
+
+@define
+class OutgoingSession:
+    """Сжатые байты отправки, хранятся до подтверждения для докачки"""
+    session_id: str
+    name: str
+    suffix: str
+    quality: int
+    chunk_size: int
+    data: bytes = field(repr=False)
+    # Размер исходника, если картинка уменьшена при сжатии
+    full_size: tuple[int, int] = field(default=(0, 0))
+    touched: float = field(factory=time.monotonic)
+    
+    @property
+    def total_chunks(self):
+        return max(1, -(-len(self.data) // self.chunk_size))
 
 
 class ImageSender(QObject):
     error_occurred = Signal(str)
+    # Служебный ответ собеседнику: (отправитель запроса, сообщение)
+    reply = Signal(str, object)
     
-    def __init__(self):
+    send_progress = Signal(str, int)
+    send_finished = Signal(str)
+    send_cancelled = Signal(str)
+    # Итог кодирования: (имя, EncodedPayload с размером, качеством и временем)
+    payload_encoded = Signal(str, object)
+    
+    # Бюджет байт: столько канал передаёт за TARGET_SECONDS
+    TARGET_SECONDS = 2.0
+    # Пока канал не измерен
+    DEFAULT_THROUGHPUT = 2 * 1024 ** 2
+    MIN_BUDGET = 128 * 1024
+    MAX_BUDGET = 16 * 1024 ** 2
+    # Без потерь одним кадром - до DIRECT_LIMIT, сжатое одним кадром - до FRAME_LIMIT
+    DIRECT_LIMIT = 500 * 1024
+    FRAME_LIMIT = 1024 * 1024
+    # Превью перед полным изображением для файлов больше PREVIEW_FROM
+    PREVIEW_FROM = 256 * 1024
+    PREVIEW_SIDE = 256
+    PREVIEW_BUDGET = 32 * 1024
+    
+    def __init__(self, window=8, session_ttl=600):
         super().__init__()
         self.client: Optional[ClientData] = None
         
         self.current_session: Optional[str] = None
+        # Кусков одной отправки в очереди сокета одновременно
+        self.window = window
+        self.jobs: set[ChunkJob] = set()
+        self.streams = itertools.count()
+        # Сжатие в пуле процессов, одно на всех получателей
+        self.service = ImageService()
+        self.payloads = PayloadCache(self.service)
+        
+        self.sessions: dict[str, OutgoingSession] = {}
+        self.session_ttl = session_ttl
+        # Собеседник по контексту диспетчера; сокет подменяет под себя
+        self.resolve_peer: Callable[[str], Optional[ClientData]] = lambda peer: self.client
+        
+        self.expire_timer = QTimer(self)
+        self.expire_timer.setInterval(60 * 1000)
+        self.expire_timer.timeout.connect(self.expire_sessions)
+        self.expire_timer.start()
+    
+    def register_handlers(self, dispatcher, peer_context=False):
+        routes = {
+            ImageActionType.RESUME_REQUEST: self._handle_resume,
+            ImageActionType.CHUNK_ACK: self._handle_ack,
+        }
+        if not peer_context:
+            routes = {action: partial(handler, "") for action, handler in routes.items()}
+        dispatcher.register_many(routes, "image", context=peer_context)
     
     @contextmanager
     def bind_socket(self, socket: ClientData):
@@ -31,40 +103,106 @@ class ImageSender(QObject):
         finally:
             self.client = None
     
+    def budget_for(self, socket: Optional[ClientData]) -> int:
+        """Бюджет байт по измеренной скорости канала собеседника"""
+        throughput = socket.queue.throughput if socket is not None and socket.queue is not None else 0
+        budget = min(max((throughput or self.DEFAULT_THROUGHPUT) * self.TARGET_SECONDS,
+                         self.MIN_BUDGET), self.MAX_BUDGET)
+        # Степень двойки: близкие замеры делят одно кодирование
+        return 1 << int(math.log2(budget))
+    
+    @classmethod
+    def strategy_for(cls, payload: EncodedPayload) -> str:
+        match len(payload.data):
+            case size if size < cls.DIRECT_LIMIT and payload.quality == 100:
+                return "direct"
+            case size if size <= cls.FRAME_LIMIT:
+                return "compress"
+            case _:
+                return "chunks"
+    
+    def prewarm(self, path, sockets: Iterable[ClientData] = ()):
+        """Начать кодирование в фоне под бюджеты собеседников, чтобы запрос получил готовое"""
+        budgets = {self.budget_for(socket) for socket in sockets} or {self.budget_for(None)}
+        return [self.payloads.prewarm(path, budget) for budget in budgets]
+    
     def send_image(self, path, name):
         if self.client is None:
             self.error_occurred.emit("Не найден сокет")
             return False
-        match os.path.getsize(path) / 1024:
-            case size if size < 500:
-                return self.send_image_direct(path, name, self.client)
-            case size if size < 1024:
-                return self.send_image_compress(path, name, self.client)
-            case _:
-                return self.send_image_chunked(path, name, self.client)
+        return self.send_image_socket(path, name, self.client)
+    
+    def send_image_socket(self, path, name, socket: ClientData, preview=False):
+        """Отправка после кодирования в пуле; GUI не ждёт сжатия.
         
-    def send_image_socket(self, path, name, socket: ClientData):
+        preview - сначала уменьшенная копия, полное изображение следом.
+        """
         if socket is None:
             self.error_occurred.emit("Не найден сокет")
             return False
-        match os.path.getsize(path) / 1024:
-            case size if size < 500:
-                return self.send_image_direct(path, name, socket)
-            case size if size < 1024:
-                return self.send_image_compress(path, name, socket)
+        try:
+            future = self.payloads.request(path, self.budget_for(socket))
+            small = None
+            if preview and os.path.getsize(path) > self.PREVIEW_FROM:
+                small = self.payloads.request(path, self.PREVIEW_BUDGET, self.PREVIEW_SIDE)
+        except Exception as e:
+            self.error_occurred.emit(f"Error: {e}")
+            return False
+        send_full = partial(self.service.then, future, partial(self._send_payload, path, name, socket),
+                            self._encode_failed)
+        if small is None:
+            send_full()
+        else:
+            # Полное изображение уходит только после превью, даже если готово раньше
+            self.service.then(small, partial(self._send_preview, path, name, socket, send_full),
+                              partial(self._skip_preview, send_full))
+        return True
+    
+    def _send_preview(self, path, name, socket: ClientData, send_full: Callable, payload: EncodedPayload):
+        self.send_image_compress(path, name, socket, payload, preview=True)
+        send_full()
+    
+    @staticmethod
+    def _skip_preview(send_full: Callable, _error: BaseException):
+        send_full()
+    
+    def _send_payload(self, path, name, socket: ClientData, payload: EncodedPayload):
+        self.payload_encoded.emit(name, payload)
+        match self.strategy_for(payload):
+            case "direct":
+                return self.send_image_direct(path, name, socket, payload)
+            case "compress":
+                return self.send_image_compress(path, name, socket, payload)
             case _:
-                return self.send_image_chunked(path, name, socket)
+                return self.send_image_chunked(path, name, socket, payload)
+    
+    def _encode_failed(self, error: BaseException):
+        self.error_occurred.emit(f"Error: {error}")
     
-    def send_image_direct(self, path, name, socket: ClientData):
+    def send_image_direct(self, path, name, socket: ClientData, payload: EncodedPayload):
         try:
-            with open(path, "rb") as file:
-                image_data = base64.b64encode(file.read()).decode("utf-8")
+            image_data = payload.data
+            if BINARY_IMAGES in socket.features:
+                stream = self._next_stream()
+                socket.send_msg(ImageSendDirect(
+                    name=name,
+                    size=len(image_data),
+                    data="",
+                    suffix=payload.suffix,
+                    stream=stream,
+                    full_size=payload.size
+                ))
+                socket.send_frame(ImageFrame.build(ImageFrameKind.DIRECT, stream, 0, image_data), bulk=True)
+                return True
+            
+            image_data = base64.b64encode(image_data).decode("utf-8")
             
             socket.send_msg(ImageSendDirect(
                 name=name,
                 size=len(image_data),
                 data=image_data,
-                suffix=Path(path).suffix
+                suffix=payload.suffix,
+                full_size=payload.size
             ))
             return True
         except Exception as e:
@@ -72,16 +210,36 @@ class ImageSender(QObject):
             self.error_occurred.emit(msg_error)
             return False
     
-    def send_image_compress(self, path, name, socket, quality=75):
+    def send_image_compress(self, path, name, socket, payload: EncodedPayload, preview=False):
         try:
-            image_data, suffix = compress_image_to_base64(path, quality)
+            image_data, suffix, quality = payload.data, payload.suffix, payload.quality
+            preview_of = payload.size if preview else (0, 0)
+            if BINARY_IMAGES in socket.features:
+                stream = self._next_stream()
+                socket.send_msg(ImageSendCompress(
+                    name=name,
+                    osize=os.path.getsize(path),
+                    csize=len(image_data),
+                    quality=quality,
+                    data="",
+                    suffix=suffix,
+                    stream=stream,
+                    preview_of=preview_of,
+                    full_size=payload.size
+                ))
+                socket.send_frame(ImageFrame.build(ImageFrameKind.COMPRESS, stream, 0, image_data), bulk=True)
+                return True
+            
+            image_data = base64.b64encode(image_data).decode("utf-8")
             socket.send_msg(ImageSendCompress(
                 name=name,
                 osize=os.path.getsize(path),
                 csize=len(image_data),
                 quality=quality,
                 data=image_data,
-                suffix=suffix
+                suffix=suffix,
+                preview_of=preview_of,
+                full_size=payload.size
             ))
             return True
         except Exception as e:
@@ -89,36 +247,67 @@ class ImageSender(QObject):
             self.error_occurred.emit(msg_error)
             return False
     
-    def send_image_chunked(self, path, name, socket, quality=60, chunk_size=64 * 1024):
+    def send_image_chunked(self, path, name, socket, payload: EncodedPayload, chunk_size=48 * 1024):
         try:
-            image_data, suffix = compress_image_to_base64(path, quality)
-            image_data = image_data.encode("utf-8")
-            chunks = [image_data[i:i + chunk_size]
-                      for i in range(0, len(image_data), chunk_size)]
-            current_session = f"session_{int(time.time() * 1000)}"
-            socket.send_msg(ImageSendChunkStart(
-                session_id=current_session,
-                name=name,
-                total_chunks=len(chunks),
-                total_size=len(image_data),
-                quality=quality,
-                chunk_size=chunk_size,
-                suffix=suffix
-            ))
-            
-            for i, chunk in enumerate(chunks):
-                QApplication.processEvents()
-                socket.send_msg(ImageSendChunk(
-                    session_id=current_session,
-                    chunk_index=i,
-                    data=chunk.decode("utf-8")
-                ))
-            
-            socket.send_msg(ImageSendChunkEnd(
-                session_id=current_session
-            ))
+            session = OutgoingSession(uuid.uuid4().hex, name, payload.suffix, payload.quality,
+                                      chunk_size - chunk_size % 3, payload.data, payload.size)
+            if RESUMABLE_IMAGES in socket.features:
+                self.sessions[session.session_id] = session
+            self._start_job(session, socket)
             return True
         except Exception as e:
             msg_error = f"Error: {e}"
             self.error_occurred.emit(msg_error)
             return False
+    
+    def _start_job(self, session: OutgoingSession, socket: ClientData, indexes=None):
+        stream = self._next_stream() if BINARY_IMAGES in socket.features else -1
+        job = ChunkJob(session.session_id, session.name, session.suffix, session.quality,
+                       io.BytesIO(session.data), len(session.data), socket,
+                       session.chunk_size, self.window, stream, indexes, session.full_size)
+        job.progress.connect(self.send_progress.emit)
+        job.finished.connect(self.send_finished.emit)
+        job.cancelled.connect(self.send_cancelled.emit)
+        job.finished.connect(partial(self._forget_job, job))
+        job.cancelled.connect(partial(self._forget_job, job))
+        self.jobs.add(job)
+        job.start()
+        return job
+    
+    def _handle_resume(self, peer: str, msg: ImageResumeRequest):
+        if (client := self.resolve_peer(peer)) is None:
+            return True
+        session = self.sessions.get(msg.session_id)
+        if session is None:
+            self.reply.emit(peer, ImageChunkCancel(session_id=msg.session_id))
+            return True
+        session.touched = time.monotonic()
+        missing = sorted({index for index in msg.missing if 0 <= index < session.total_chunks})
+        self._start_job(session, client, missing)
+        return True
+    
+    def _handle_ack(self, peer: str, msg: ImageChunkAck):
+        if session := self.sessions.get(msg.session_id):
+            session.touched = time.monotonic()
+            if msg.complete:
+                del self.sessions[msg.session_id]
+        return True
+    
+    def expire_sessions(self):
+        """Забыть отправки, по которым давно нет ни подтверждений, ни докачки"""
+        deadline = time.monotonic() - self.session_ttl
+        active = {job.session_id for job in self.jobs}
+        for session_id, session in list(self.sessions.items()):
+            if session.touched < deadline and session_id not in active:
+                del self.sessions[session_id]
+    
+    def cancel(self, session_id: str):
+        for job in list(self.jobs):
+            if job.session_id == session_id:
+                job.cancel()
+    
+    def _next_stream(self) -> int:
+        return next(self.streams) % 2 ** 32
+    
+    def _forget_job(self, job: ChunkJob, *_):
+        self.jobs.discard(job)
@@ -0,0 +1,114 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Optional
+
+from PySide6.QtCore import QObject, Signal
+
+
+class ImageService(QObject):
+    """Тяжёлая работа с изображениями (PIL) в пуле процессов.
+    
+    Одновременно в пуле не больше max_pending задач, остальные ждут в
+    очереди и могут быть отменены до старта. Колбэки then() вызываются
+    в потоке GUI: завершение пула переправляется сигналом.
+    
+    Future задачи остаётся в ожидании до результата: отмена переданной
+    в пул задачи, которую пул ещё не начал, отменяет и его.
+    Future пула отменяется и получает колбэки только вне блокировки:
+    колбэк готового Future выполняется сразу, в том же потоке.
+    """
+    _completed = Signal(object)
+    
+    def __init__(self, workers=2, max_pending=4):
+        super().__init__()
+        self.workers = workers
+        self.max_pending = max_pending
+        
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._backlog: deque[tuple[Future, Callable, tuple]] = deque()
+        self._running: dict[Future, Future] = {}
+        self._callbacks: dict[Future, list[tuple[Callable, Optional[Callable]]]] = {}
+        
+        self._completed.connect(self._deliver)
+    
+    def submit(self, fn: Callable, *args) -> Future:
+        """fn должна быть функцией верхнего уровня модуля без Qt: её запускает другой процесс"""
+        future = Future()
+        with self._lock:
+            self._backlog.append((future, fn, args))
+            started = self._pump()
+        self._watch(started)
+        return future
+    
+    def cancel(self, future: Future) -> bool:
+        with self._lock:
+            inner = next((inner for inner, outer in self._running.items() if outer is future), None)
+        if inner is None:
+            # Ещё в очереди: _pump пропустит отменённую
+            return future.cancel()
+        # Отмена вызовет _inner_done, а он отменит и future
+        return inner.cancel()
+    
+    def then(self, future: Future, done: Callable, error: Optional[Callable] = None):
+        """done(результат) или error(исключение) в потоке GUI"""
+        self._callbacks.setdefault(future, []).append((done, error))
+        future.add_done_callback(self._completed.emit)
+    
+    def shutdown(self):
+        with self._lock:
+            for future, _, _ in self._backlog:
+                future.cancel()
+            self._backlog.clear()
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _pump(self) -> list[Future]:
+        """Передать задачи из очереди в пул; вызывается под блокировкой.
+        
+        Возвращает Future пула, на которые вызывающий подписывается через _watch уже без блокировки.
+        """
+        started = []
+        while self._backlog and len(self._running) < self.max_pending:
+            future, fn, args = self._backlog.popleft()
+            if future.cancelled():
+                continue
+            if self._pool is None:
+                # spawn: fork процесса с Qt и потоками небезопасен
+                self._pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"))
+            inner = self._pool.submit(fn, *args)
+            self._running[inner] = future
+            started.append(inner)
+        return started
+    
+    def _watch(self, started: list[Future]):
+        for inner in started:
+            inner.add_done_callback(self._inner_done)
+    
+    def _inner_done(self, inner: Future):
+        with self._lock:
+            future = self._running.pop(inner)
+            started = self._pump()
+        self._watch(started)
+        if inner.cancelled():
+            future.cancel()
+        elif future.cancelled():
+            # Отменена в обход пула, пока выполнялась: результат уже не нужен
+            return
+        elif (exc := inner.exception()) is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(inner.result())
+    
+    def _deliver(self, future: Future):
+        for done, error in self._callbacks.pop(future, ()):
+            if future.cancelled():
+                continue
+            if (exc := future.exception()) is not None:
+                if error is not None:
+                    error(exc)
+            else:
+                done(future.result())
@@ -1,7 +1,8 @@
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Any
 
 from attrs import define, field
+from PySide6.QtWidgets import QWidget
 
 from CommonTools.map_widget import MapWidget
 
@@ -10,4 +11,19 @@ from CommonTools.map_widget import MapWidget
 class MapData:
     name: str
     visible: bool
-    mWidget: MapWidget
+    # Страница вкладки; MapWidget создаётся в ней при первом показе
+    page: QWidget
+    mWidget: Optional[MapWidget] = None
+
+    # Состояние карты, пока виджета нет: токены mime -> позиция и последний фон
+    tokens: dict[str, tuple[float, float]] = field(factory=dict)
+    background: Optional[tuple[str, tuple[Any, ...]]] = None
+    background_path: Optional[Path] = None
+    
+    @property
+    def is_built(self):
+        return self.mWidget is not None
+    
+    @property
+    def file_map(self):
+        return self.mWidget.file_map if self.is_built else self.background_path
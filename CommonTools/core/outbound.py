@@ -0,0 +1,47 @@
+from typing import Callable, Hashable, Optional
+
+from PySide6.QtCore import QObject, QTimer
+
+from CommonTools.messages import BaseMessage
+
+
+class OutboundCoalescer(QObject):
+    """Исходящие обновления состояния с фиксированной частотой отправки.
+    
+    Сообщения копятся по ключу (тип, сущность), побеждает последняя запись;
+    в sink они уходят раз в тик. Пока очередь пуста, таймер стоит.
+    """
+    
+    def __init__(self, sink: Callable[[BaseMessage], None], rate_hz: float = 25, parent=None):
+        super().__init__(parent)
+        self.sink = sink
+        self.pending: dict[Hashable, BaseMessage] = {}
+        self.posted = 0
+        self.sent = 0
+        
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.flush)
+        self.set_rate(rate_hz)
+    
+    def set_rate(self, rate_hz: float):
+        self.timer.setInterval(max(1, round(1000 / rate_hz)))
+    
+    def post(self, msg: BaseMessage, key: Optional[Hashable] = None):
+        self.pending[msg.coalesce_key() if key is None else key] = msg
+        self.posted += 1
+        if not self.timer.isActive():
+            self.timer.start()
+    
+    def discard(self, key: Hashable):
+        self.pending.pop(key, None)
+    
+    def flush(self):
+        """Отправить накопленное; повторный вызов из sink ничего не делает"""
+        self.timer.stop()
+        pending, self.pending = self.pending, {}
+        for msg in pending.values():
+            self.sent += 1
+            self.sink(msg)
+    
+    def __len__(self):
+        return len(self.pending)
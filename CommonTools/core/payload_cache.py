@@ -0,0 +1,101 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Optional
+
+from attrs import define, field
+
+from CommonTools.utils import encode_image
+from .image_service import ImageService
+
+
+@define
+class EncodedPayload:
+    data: bytes = field(repr=False)
+    suffix: str
+    quality: int = field(default=100)
+    # Время кодирования в пуле, с
+    seconds: float = field(default=0.0)
+    # Размер исходного изображения, если картинка уменьшена
+    size: tuple[int, int] = field(default=(0, 0))
+
+
+class PayloadCache:
+    """Закодированные изображения по (путь, mtime, бюджет байт, сторона превью).
+    
+    Один фон для всех игроков сжимается один раз; кодирование идёт в пуле
+    процессов ImageService, поток GUI получает готовый Future.
+    Старые записи вытесняются при превышении бюджета памяти.
+    """
+    
+    def __init__(self, service: ImageService, max_bytes=256 * 1024 ** 2):
+        self.service = service
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, EncodedPayload] = OrderedDict()
+        self._pending: dict[tuple, Future] = {}
+        # Задачи пула по тем же ключам - для отмены
+        self._encoding: dict[tuple, Future] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(path, budget: Optional[int], max_side: Optional[int] = None) -> tuple:
+        return str(Path(path).resolve()), os.stat(path).st_mtime_ns, budget, max_side
+    
+    def request(self, path, budget: Optional[int] = None, max_side: Optional[int] = None) -> Future:
+        """Future с EncodedPayload: готовый из кеша, уже идущий или новый"""
+        key = self.key(path, budget, max_side)
+        with self._lock:
+            if (payload := self._entries.get(key)) is not None:
+                self._entries.move_to_end(key)
+                future = Future()
+                future.set_result(payload)
+                return future
+            if (future := self._pending.get(key)) is not None:
+                return future
+            future = self._pending[key] = Future()
+        
+        encoded = self._encoding[key] = self.service.submit(encode_image, path, budget, max_side)
+        encoded.add_done_callback(partial(self._encoded, key, future))
+        return future
+    
+    def prewarm(self, path, budget: Optional[int] = None) -> Future:
+        return self.request(path, budget)
+    
+    def cancel(self, path, budget: Optional[int] = None, max_side: Optional[int] = None) -> bool:
+        """Отменить кодирование, если оно ещё не началось"""
+        with self._lock:
+            encoded = self._encoding.get(self.key(path, budget, max_side))
+        return encoded is not None and self.service.cancel(encoded)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+    
+    def _encoded(self, key: tuple, future: Future, encoded: Future):
+        """Результат пула: в кеш и ожидающим; вызывается не из потока GUI"""
+        with self._lock:
+            self._pending.pop(key, None)
+            self._encoding.pop(key, None)
+            if encoded.cancelled() or encoded.exception() is not None:
+                payload = None
+            else:
+                payload = EncodedPayload(*encoded.result())
+                if key not in self._entries:
+                    self._entries[key] = payload
+                    self._size += len(payload.data)
+                while self._size > self.max_bytes and len(self._entries) > 1:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted.data)
+        if future.cancelled():
+            return
+        if payload is not None:
+            future.set_result(payload)
+        elif encoded.cancelled():
+            future.cancel()
+        else:
+            future.set_exception(encoded.exception())
@@ -0,0 +1,145 @@
+import time
+from collections import deque
+from typing import Hashable, Optional
+
+from PySide6.QtCore import QObject, QTimer, Signal
+from PySide6.QtWebSockets import QWebSocket
+
+
+class SendQueue(QObject):
+    """Исходящая очередь одного собеседника с обратным давлением.
+    
+    В сокет отдаётся не больше high_water байт, ещё не ушедших в сеть,
+    остальное ждёт сигнала bytesWritten или следующего тика. Массовая
+    полоса подкладывает кадры, только пока в сокете меньше bulk_water
+    байт: управляющий кадр не встаёт в буфер Qt за мегабайтами изображения.
+    
+    Две полосы, у каждой свой бюджет байт на тик:
+    - управляющая: команды и обновления состояния. Кадры с ключом - обновления
+      состояния: новый кадр с тем же ключом вытесняет ещё не отправленный.
+      Кадры без ключа доставляются всегда и по порядку;
+    - массовая: изображения, только когда управляющая полоса пуста.
+    
+    Пока в сокете есть очередь, по bytesWritten оценивается пропускная
+    способность канала (throughput, байт/с).
+    """
+    
+    # Массовая полоса продвинулась: можно подкладывать следующие куски
+    bulk_sent = Signal()
+    
+    def __init__(self, socket: QWebSocket, high_water=512 * 1024, tick_ms=20,
+                 control_budget=256 * 1024, bulk_budget=128 * 1024, bulk_water=48 * 1024):
+        super().__init__(socket)
+        self.socket = socket
+        self.high_water = high_water
+        # Около одного куска изображения в полёте
+        self.bulk_water = min(bulk_water, high_water)
+        self.control_budget = control_budget
+        self.bulk_budget = bulk_budget
+        
+        # [ключ, кадр]; кадр None - вытесненная запись
+        self.control: deque[list] = deque()
+        self.bulk: deque[str | bytes] = deque()
+        self.latest: dict[Hashable, list] = {}
+        self.depth = 0
+        self.dropped = 0
+        
+        self.control_spent = 0
+        self.bulk_spent = 0
+        
+        self.timer = QTimer(self)
+        self.timer.setInterval(tick_ms)
+        self.timer.timeout.connect(self._tick)
+        
+        # Замер канала: байты и начало текущего отрезка занятости
+        self.throughput = 0.0
+        self.sample_bytes = 0
+        self.sample_start = 0.0
+        
+        self.socket.bytesWritten.connect(self._measure)
+        self.socket.bytesWritten.connect(self.pump)
+    
+    def push(self, frame: str | bytes, key: Optional[Hashable] = None, bulk=False):
+        if bulk:
+            self.bulk.append(frame)
+        else:
+            if key is not None and (stale := self.latest.pop(key, None)) is not None:
+                stale[1] = None
+                self.depth -= 1
+                self.dropped += 1
+            entry = [key, frame]
+            self.control.append(entry)
+            if key is not None:
+                self.latest[key] = entry
+        self.depth += 1
+        self.pump()
+    
+    def pump(self, *_):
+        if not self.timer.isActive():
+            # Первая отправка после простоя открывает новый тик
+            self.control_spent = 0
+            self.bulk_spent = 0
+            self.timer.start()
+        while self.control and self.control_spent < self.control_budget and self._writable():
+            key, frame = self.control.popleft()
+            if frame is None:
+                continue
+            if key is not None:
+                self.latest.pop(key, None)
+            self.control_spent += self._send(frame)
+        # Массовые кадры только в паузах управляющей полосы
+        sent_bulk = False
+        while (not self.control and self.bulk
+               and self.bulk_spent < self.bulk_budget and self._writable(self.bulk_water)):
+            self.bulk_spent += self._send(self.bulk.popleft())
+            sent_bulk = True
+        if sent_bulk:
+            self.bulk_sent.emit()
+    
+    @property
+    def bulk_depth(self) -> int:
+        return len(self.bulk)
+    
+    def clear(self):
+        self.control.clear()
+        self.bulk.clear()
+        self.latest.clear()
+        self.depth = 0
+        self.timer.stop()
+
+    def _tick(self):
+        self.control_spent = 0
+        self.bulk_spent = 0
+        if not self.control and not self.bulk:
+            self.timer.stop()
+            return
+        self.pump()
+    
+    def _measure(self, written: int, sample_time=0.25, smoothing=0.3):
+        now = time.monotonic()
+        if not self.bulk and not self.control and self.socket.bytesToWrite() == 0:
+            # Канал простаивает: отрезок обрывается, по нему скорость не оценить
+            self.sample_bytes = 0
+            self.sample_start = 0.0
+            return
+        if not self.sample_start:
+            self.sample_start = now
+            return
+        self.sample_bytes += written
+        if (elapsed := now - self.sample_start) >= sample_time:
+            rate = self.sample_bytes / elapsed
+            self.throughput = rate if not self.throughput else (
+                    smoothing * rate + (1 - smoothing) * self.throughput)
+            self.sample_bytes = 0
+            self.sample_start = now
+    
+    def _writable(self, limit: Optional[int] = None):
+        return self.socket.bytesToWrite() < (limit or self.high_water)
+    
+    def _send(self, frame: str | bytes) -> int:
+        self.depth -= 1
+        if isinstance(frame, str):
+            self.socket.sendTextMessage(frame)
+        else:
+            self.socket.sendBinaryMessage(frame)
+        return len(frame)
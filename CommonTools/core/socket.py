@@ -1,35 +1,128 @@
-import json5
-from PySide6.QtCore import QObject, Signal
+from typing import Optional
+
+from PySide6.QtCore import QObject, Signal, QTimer
 
 from .client_data import ClientData
+from .frame_stats import FrameStats
+from .dispatcher import MessageDispatcher
+from .outbound import OutboundCoalescer
 from .image_sender import ImageSender
 from .image_receiver import ImageReceiver
-from CommonTools.messages import BaseMessage
+from CommonTools.messages import BaseMessage, MapActionType, ImageFrame, RESUMABLE_IMAGES
 
 
 class Socket(QObject):
-    message_received = Signal(str)
+    message_received = Signal(object)
     image_received = Signal(object)
     chunk_progress = Signal(str, int)
+    tiles_announced = Signal(object)
+    tile_received = Signal(object)
     
     error_occurred = Signal(str)
     
-    def __init__(self, socket):
+    # Типы, у которых из пачки доживает только последнее сообщение по ключу
+    SUPERSEDABLE = frozenset({MapActionType.MOVE_TOKEN, MapActionType.MAP_GRID_DATA, MapActionType.PLAYER_MOVED})
+    # Обработчики получают отправителя кадра первым аргументом (сервер - uid)
+    peer_context = False
+    
+    def __init__(self, socket, flush_rate: float = 25):
         super().__init__()
         self.socket = socket
         self.client = ClientData("", "", "", socket)
+        self.stats = FrameStats()
+        self.dispatcher = MessageDispatcher()
+        # Перетаскивания и правки сетки уходят не чаще flush_rate раз в секунду
+        self.outbound = OutboundCoalescer(self.send_msg, flush_rate, self)
+        # Входящие кадры (контекст, кадр) до ближайшего прохода цикла событий
+        self.inbound: list[tuple[tuple, str | bytes]] = []
         
         self.image_sender = ImageSender()
         self.image_sender.error_occurred.connect(self.error_occurred.emit)
+        self.image_sender.reply.connect(self.reply)
+        self.image_sender.resolve_peer = self.peer_client
+        self.image_sender.register_handlers(self.dispatcher, self.peer_context)
         
         self.image_receiver = ImageReceiver()
         self.image_receiver.image_received.connect(self.image_received.emit)
         self.image_receiver.chunk_progress.connect(self.chunk_progress.emit)
+        self.image_receiver.tiles_announced.connect(self.tiles_announced.emit)
+        self.image_receiver.tile_received.connect(self.tile_received.emit)
         self.image_receiver.error_occurred.connect(self.error_occurred.emit)
+        self.image_receiver.reply.connect(self.reply)
+        self.image_receiver.register_handlers(self.dispatcher, self.peer_context)
+    
+    def decode(self, frame: str | bytes) -> BaseMessage | ImageFrame:
+        """Единственный разбор кадра: дальше по сигналам ходит готовый объект"""
+        if ImageFrame.is_frame(frame):
+            msg = ImageFrame.parse(frame)
+        else:
+            msg = BaseMessage.from_str(frame)
+        self.stats.frame_decoded()
+        return msg
+    
+    def enqueue(self, frame: str | bytes, *context):
+        """Отложить кадр: очередь разбирается один раз за проход цикла событий"""
+        if not self.inbound:
+            QTimer.singleShot(0, self.drain_inbound)
+        self.inbound.append((context, frame))
+    
+    def drain_inbound(self):
+        """Разобрать накопленные кадры и применить их одной пачкой.
+        
+        Перемещения и правки сетки, которые перекрывает более позднее
+        сообщение той же сущности от того же отправителя, отбрасываются.
+        """
+        queue, self.inbound = self.inbound, []
+        decoded: list[tuple[tuple, BaseMessage]] = []
+        for context, frame in queue:
+            try:
+                decoded.append((context, self.decode(frame)))
+            except ValueError as e:
+                self.error_occurred.emit(f"Некорректный кадр: {e}")
+        
+        latest: dict[tuple, int] = {}
+        for index, (context, msg) in enumerate(decoded):
+            if msg.type in self.SUPERSEDABLE:
+                latest[(context, msg.coalesce_key())] = index
+        
+        with self.dispatcher.batch():
+            for index, (context, msg) in enumerate(decoded):
+                if msg.type in self.SUPERSEDABLE and latest[(context, msg.coalesce_key())] != index:
+                    self.stats.frame_superseded()
+                    continue
+                # Очередь уже забрана: ошибка обработчика не должна терять остаток пачки
+                try:
+                    self.deliver(msg, *context)
+                except Exception as e:
+                    self.error_occurred.emit(f"Ошибка обработки {msg.type}: {e!r}")
+    
+    def deliver(self, msg: BaseMessage, *context):
+        self.stats.frame_delivered()
+        self.dispatcher.dispatch(msg, *context)
+        self.message_received.emit(msg)
     
     def send_msg(self, msg: BaseMessage):
-        self.socket.sendTextMessage(json5.dumps(msg.to_dict(), ensure_ascii=False))
+        # Отложенные обновления уходят раньше, чтобы не нарушить порядок
+        self.outbound.flush()
+        self.client.send_msg(msg)
+    
+    def post(self, msg: BaseMessage, key=None):
+        """Отправить со схлопыванием: до тика доживает последнее по ключу"""
+        self.outbound.post(msg, key)
+    
+    def flush(self):
+        self.outbound.flush()
+    
+    def peer_client(self, peer: str) -> Optional[ClientData]:
+        """Собеседник по контексту диспетчера"""
+        return self.client
+    
+    def reply(self, peer: str, msg: BaseMessage):
+        """Служебный ответ о передаче изображения, если собеседник его понимает"""
+        client = self.peer_client(peer)
+        if client is not None and RESUMABLE_IMAGES in client.features:
+            client.send_msg(msg)
     
     def send_image(self, path, name):
         self.image_sender.send_image(path, name)
-    
+
@@ -4,6 +4,7 @@ from PySide6.QtCore import Signal, QPointF
 
 class GraphicsScene(QGraphicsScene):
     item_moved = Signal(object)
+    item_released = Signal(object)
     item_added = Signal(object)
     item_removed = Signal(object)
     
@@ -0,0 +1,123 @@
+import hashlib
+import itertools
+import math
+import os
+from typing import Callable, Optional
+
+from PySide6.QtCore import Qt, QObject, QRunnable, QThreadPool, QSize, Signal
+from PySide6.QtGui import QImage, QImageReader, QPixmap
+
+from .pixmap_cache import PixmapCache
+
+
+class _DecodeTask(QRunnable):
+    def __init__(self, loader: "ImageLoader", path: str):
+        super().__init__()
+        # Задача нужна после старта: по ней отменяем ещё не начатое декодирование
+        self.setAutoDelete(False)
+        self.loader = loader
+        self.path = path
+    
+    def run(self):
+        self.loader._finished.emit(self.path, self.loader.decode(self.path))
+
+
+class ImageLoader(QObject):
+    """Декодирование фонов в пуле потоков Qt.
+    
+    Изображение больше бюджета памяти читается сразу уменьшенным через
+    QImageReader.setScaledSize, полный размер в памяти не появляется.
+    Результат ложится в общий PixmapCache по хешу содержимого вместе с
+    миниатюрой; повторная загрузка того же файла берётся из кеша, а пока
+    файл в работе - ждёт тот же результат. Колбэки вызываются в потоке GUI.
+    """
+    _finished = Signal(str, object)
+    
+    # Байт на декодированное изображение; Qt по умолчанию отказывается от больших 256 МБ
+    MAX_BYTES = 128 * 1024 * 1024
+    # Большая сторона миниатюры
+    THUMB_SIDE = 512
+    
+    _shared: Optional["ImageLoader"] = None
+    
+    def __init__(self, max_bytes=MAX_BYTES):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.pool = QThreadPool.globalInstance()
+        self.pixmaps = PixmapCache()
+        
+        self._tickets = itertools.count(1)
+        self._tasks: dict[str, _DecodeTask] = {}
+        self._waiters: dict[str, dict[int, Callable[[str], None]]] = {}
+        # Путь -> (mtime, размер, хеш): хеш файла считается один раз
+        self._digests: dict[str, tuple[int, int, str]] = {}
+        
+        self._finished.connect(self._deliver)
+    
+    @classmethod
+    def shared(cls) -> "ImageLoader":
+        """Общий загрузчик: одинаковые файлы разных карт декодируются вместе"""
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+    
+    def cached(self, path) -> Optional[str]:
+        """Хеш файла, если он уже декодирован и лежит в кеше"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        known = self._digests.get(str(path))
+        if known is None or known[:2] != (stat.st_mtime_ns, stat.st_size) or known[2] not in self.pixmaps:
+            return None
+        return known[2]
+    
+    def load(self, path, callback: Callable[[str], None]) -> int:
+        """callback(хеш) в потоке GUI, изображение - в pixmaps; пустой хеш - файл не прочитан"""
+        path = str(path)
+        ticket = next(self._tickets)
+        self._waiters.setdefault(path, {})[ticket] = callback
+        if path not in self._tasks:
+            self._tasks[path] = task = _DecodeTask(self, path)
+            self.pool.start(task)
+        return ticket
+    
+    def cancel(self, ticket: Optional[int]):
+        for path, waiters in self._waiters.items():
+            if waiters.pop(ticket, None) is None:
+                continue
+            # Файл больше никто не ждёт: снимаем задачу, если она ещё в очереди
+            if not waiters and self.pool.tryTake(self._tasks[path]):
+                del self._tasks[path]
+                del self._waiters[path]
+            return
+    
+    def decode(self, path: str) -> Optional[tuple[int, int, str, QImage, QImage]]:
+        """Вызывается в потоке пула: (mtime, размер, хеш, изображение, миниатюра)"""
+        try:
+            stat = os.stat(path)
+            with open(path, "rb") as file:
+                digest = hashlib.file_digest(file, "sha256").hexdigest()
+        except OSError:
+            return None
+        reader = QImageReader(path)
+        size = reader.size()
+        if size.isValid() and size.width() * size.height() * 4 > self.max_bytes:
+            scale = math.sqrt(self.max_bytes / (size.width() * size.height() * 4))
+            reader.setScaledSize(QSize(max(1, int(size.width() * scale)), max(1, int(size.height() * scale))))
+        image = reader.read()
+        if image.isNull():
+            return None
+        thumbnail = image.scaled(QSize(self.THUMB_SIDE, self.THUMB_SIDE), Qt.AspectRatioMode.KeepAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+        return stat.st_mtime_ns, stat.st_size, digest, image, thumbnail
+    
+    def _deliver(self, path: str, result: Optional[tuple[int, int, str, QImage, QImage]]):
+        self._tasks.pop(path, None)
+        digest = ""
+        if result is not None:
+            mtime, size, digest, image, thumbnail = result
+            self._digests[path] = (mtime, size, digest)
+            self.pixmaps.put(digest, QPixmap.fromImage(image), QPixmap.fromImage(thumbnail))
+        for callback in self._waiters.pop(path, {}).values():
+            callback(digest)
@@ -1,7 +1,7 @@
 from pathlib import Path
 from typing import Optional
 
-from PySide6.QtCore import Qt, QPointF, Signal, QPoint
+from PySide6.QtCore import Qt, QPointF, Signal, QPoint, QSizeF, QTimer
 from PySide6.QtGui import QMouseEvent, QKeyEvent, QWheelEvent, QPainter, QCursor
 from PySide6.QtWidgets import QGraphicsView, QGraphicsItem, QMenu, QApplication
 
@@ -17,8 +17,14 @@ class MapWidget(QGraphicsView):
     token_added = Signal(object)
     token_removed = Signal(object)
     token_moved = Signal(object, tuple)
+    token_released = Signal(object, tuple)
     
     token_moved_map = Signal(object, str)
+    # Нужны тайлы фона: (уровень, [(столбец, строка)])
+    tiles_needed = Signal(int, list)
+    
+    # Запас вокруг видимой области, доля её размера
+    TILE_MARGIN = 0.5
     
     def __init__(self, client: ClientData):
         super().__init__()
@@ -29,6 +35,7 @@ class MapWidget(QGraphicsView):
         self.g_scene.item_added.connect(self._handle_token_add)
         self.g_scene.item_removed.connect(self._handle_token_remove)
         self.g_scene.item_moved.connect(self._handle_token_move)
+        self.g_scene.item_released.connect(self._handle_token_release)
         self.g_scene.item_moved2.connect(self._handle_token_move_map)
         self.setScene(self.g_scene)
         
@@ -44,6 +51,16 @@ class MapWidget(QGraphicsView):
         
         self._setup_view()
         
+        # Запрос тайлов раз после серии прокруток и масштабирований
+        self.tile_timer = QTimer(self, singleShot=True, interval=50)
+        self.tile_timer.timeout.connect(self._request_tiles)
+        self.view_controller.on_view_changed = self.tile_timer.start
+        # Повтор запроса тайлов, на которые не пришёл ответ, даже если вид не меняется
+        self.tile_retry = QTimer(self, singleShot=True, interval=int(MapWithGridItem.TILE_TIMEOUT * 1000))
+        self.tile_retry.timeout.connect(self._request_tiles)
+        self.horizontalScrollBar().valueChanged.connect(self.tile_timer.start)
+        self.verticalScrollBar().valueChanged.connect(self.tile_timer.start)
+        
         self.movement_settings = {
             'players': True,  # Игроки не перемещаются в режиме игрока
             'mobs': True,  # Мобы не перемещаются в режиме игрока
@@ -88,6 +105,7 @@ class MapWidget(QGraphicsView):
         if isinstance(item, BaseToken):
             if item.ttype == "spawn":
                 self.token_spawn = None
+            self.token_manager.forget(item)
             self.token_removed.emit(item)
     
     def _handle_token_move_map(self, item, nameMap):
@@ -98,6 +116,10 @@ class MapWidget(QGraphicsView):
         if isinstance(item, BaseToken):
             self.token_moved.emit(item, item.pos().toTuple())
     
+    def _handle_token_release(self, item):
+        if isinstance(item, BaseToken):
+            self.token_released.emit(item, item.pos().toTuple())
+    
     def set_token_movement(self, token_types: list[str], enabled: bool):
         """Включает/выключает возможность перемещения для типов токенов"""
         for token_type in token_types:
@@ -161,9 +183,53 @@ class MapWidget(QGraphicsView):
                 item.setPPSize(size)
         self.token_manager.base_size = size
     
-    def load_map(self, file_path):
+    def load_map(self, file_path, full_size: Optional[QSizeF] = None):
         self.file_map = file_path
-        return self.view_controller.load_map(file_path)
+        return self.view_controller.load_map(file_path, full_size)
+    
+    def load_preview(self, file_path, full_size: QSizeF):
+        self.file_map = file_path
+        return self.view_controller.load_preview(file_path, full_size)
+    
+    def load_tiled(self, full_size: QSizeF, tile_size: int, levels: int, file_path=None):
+        """file_path - исходник фона, если он есть (у мастера)"""
+        self.file_map = file_path
+        if not self.view_controller.load_tiled(full_size, tile_size, levels):
+            return False
+        # Самый грубый уровень - подложка под всю карту
+        map_item = self.view_controller.map_item
+        self.tiles_needed.emit(levels - 1, map_item.missing_tiles(map_item.boundingRect(), levels - 1))
+        self.tile_timer.start()
+        return True
+    
+    def set_active(self, active: bool):
+        """Неактивная карта держит в памяти только миниатюру фона"""
+        self.view_controller.set_active(active)
+    
+    def add_tile(self, level: int, col: int, row: int, data: bytes):
+        return self.view_controller.map_item.add_tile(level, col, row, data)
+    
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.tile_timer.start()
+    
+    def _request_tiles(self):
+        """Запросить тайлы видимой области с запасом на прокрутку"""
+        map_item = self.view_controller.map_item
+        if not map_item.is_tiled:
+            return
+        rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        dx, dy = rect.width() * self.TILE_MARGIN, rect.height() * self.TILE_MARGIN
+        rect = map_item.mapRectFromScene(rect.adjusted(-dx, -dy, dx, dy))
+        level = self.view_controller.level()
+        # Подложка грубого уровня тоже могла потеряться
+        coarse = map_item.levels - 1
+        if level != coarse and (missing := map_item.missing_tiles(map_item.boundingRect(), coarse)):
+            self.tiles_needed.emit(coarse, missing)
+        if missing := map_item.missing_tiles(rect, level):
+            self.tiles_needed.emit(level, missing)
+        if map_item.requested:
+            self.tile_retry.start()
     
     def fit_to_view(self):
         self.view_controller.fit_to_view()
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from typing import Optional
+
+from attrs import define
+from PySide6.QtGui import QPixmap
+
+
+@define
+class CachedPixmap:
+    pixmap: QPixmap
+    # Уменьшенная копия для неактивных карт
+    thumbnail: QPixmap
+    refs: int = 0
+    
+    @property
+    def nbytes(self) -> int:
+        return self.pixmap.width() * self.pixmap.height() * max(self.pixmap.depth(), 8) // 8
+
+
+class PixmapCache:
+    """Декодированные фоны по хешу содержимого, общие для всех карт.
+    
+    Карта держит ссылку на фон, пока показывает его в полном размере;
+    фон без ссылок остаётся в памяти до превышения бюджета и вытесняется
+    от давно не нужных к свежим. Фоны со ссылками не вытесняются никогда.
+    """
+    
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # От давно использованных к свежим
+        self._entries: OrderedDict[str, CachedPixmap] = OrderedDict()
+        self._size = 0
+    
+    def __contains__(self, digest: str):
+        return digest in self._entries
+    
+    def get(self, digest: str) -> Optional[CachedPixmap]:
+        if (entry := self._entries.get(digest)) is not None:
+            self._entries.move_to_end(digest)
+        return entry
+    
+    def put(self, digest: str, pixmap: QPixmap, thumbnail: QPixmap) -> CachedPixmap:
+        """Тот же фон, декодированный дважды, хранится один раз"""
+        if (entry := self.get(digest)) is not None:
+            return entry
+        self._entries[digest] = entry = CachedPixmap(pixmap, thumbnail)
+        self._size += entry.nbytes
+        # Новый фон ещё никто не успел взять - его не вытесняем
+        self._trim(keep=digest)
+        return entry
+    
+    def acquire(self, digest: str) -> Optional[QPixmap]:
+        if (entry := self.get(digest)) is None:
+            return None
+        entry.refs += 1
+        return entry.pixmap
+    
+    def release(self, digest: Optional[str]):
+        if (entry := self._entries.get(digest)) is None:
+            return
+        entry.refs = max(entry.refs - 1, 0)
+        self._trim()
+    
+    @property
+    def size(self) -> int:
+        return self._size
+    
+    def _trim(self, keep: Optional[str] = None):
+        for digest in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            entry = self._entries[digest]
+            if entry.refs == 0 and digest != keep:
+                del self._entries[digest]
+                self._size -= entry.nbytes
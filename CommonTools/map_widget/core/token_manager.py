@@ -38,6 +38,11 @@ class TokenManager(QObject):
             self.tokens.pop(mime, None)
             return True
     
+    def forget(self, token: BaseToken):
+        """Убрать из реестра токен, снятый со сцены в обход remove_token"""
+        if self.tokens.get(token.mime()) is token:
+            del self.tokens[token.mime()]
+    
     def _create_token(self, mime: str, pos: QPointF) -> Optional[BaseToken]:
         match mime.split(":"):
             case ["player", name, cls, uid]:
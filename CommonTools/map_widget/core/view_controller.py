@@ -1,7 +1,12 @@
-from PySide6.QtCore import Qt, QPoint
-from PySide6.QtGui import QPixmap, QKeyEvent, QWheelEvent
+from functools import partial
+from pathlib import Path
+from typing import Callable, Optional
+
+from PySide6.QtCore import Qt, QPoint, QSizeF
+from PySide6.QtGui import QImageReader, QPixmap, QKeyEvent, QWheelEvent
 from PySide6.QtWidgets import QGraphicsView, QGraphicsScene
 
+from .image_loader import ImageLoader
 from ..tokens_dnd import MapWithGridItem
 
 
@@ -18,26 +23,134 @@ class ViewController:
         self.map_item: MapWithGridItem = MapWithGridItem()
         self.zoom_level = 1.0
         
+        self.loader = ImageLoader.shared()
+        # Незавершённая загрузка фона
+        self._ticket: Optional[int] = None
+        # Хеш фона, который карта держит в кеше в полном размере
+        self._digest: Optional[str] = None
+        # Неактивная карта показывает миниатюру, полный фон перечитается при активации
+        self.active = True
+        self._dormant: Optional[Path] = None
+        
         # Настройки масштабирования
         self.zoom_factor = 1.15
         self.zoom_min = 0.1
         self.zoom_max = 10.0
+        
+        # Видимая область или масштаб изменились; виджет подменяет под себя
+        self.on_view_changed: Callable[[], None] = lambda: None
     
     def clear(self):
+        self._drop()
         self.map_item.clear()
     
-    def load_map(self, file_path):
-        self.scene.clear()
+    def load_map(self, file_path, full_size: Optional[QSizeF] = None):
+        """Фон декодируется в пуле потоков; до готовности на сцене место под него по размеру из заголовка.
         
-        pixmap = QPixmap(file_path)
-        if not pixmap.isNull():
+        full_size - размер исходника, если файл - уменьшенная при сжатии копия: фон растягивается до него.
+        """
+        self._drop()
+        reader = QImageReader(str(file_path))
+        if not reader.canRead():
+            return False
+        
+        if reader.supportsAnimation() and reader.imageCount() > 1:
+            # Кадры анимации QMovie декодирует сам по мере показа
             self.map_item.load(file_path)
-            self.scene.addItem(self.map_item)
-            self.scene.setSceneRect(self.map_item.boundingRect())
-            self.updateGridRender()
-            self.fit_to_view()
+            self._reset_scene()
             return True
-        return False
+        
+        # Превью уже на сцене остаётся до готовности оригинала, токены на местах
+        refine = self.map_item.is_preview and self.map_item.scene() is self.scene
+        if full_size is None or full_size.isEmpty():
+            # Превью занимает место исходника; файл может оказаться уменьшенной копией
+            full_size = self.map_item.boundingRect().size() if refine else QSizeF(reader.size())
+        if (digest := self.loader.cached(file_path)) is not None:
+            self._show(file_path, full_size, digest)
+            if not refine:
+                self._reset_scene()
+            return True
+        
+        if not refine:
+            self.map_item.load_placeholder(file_path, full_size)
+            self._reset_scene()
+        self._ticket = self.loader.load(file_path, partial(self._on_loaded, file_path, full_size))
+        return True
+    
+    def load_preview(self, file_path, full_size: QSizeF):
+        """Показать превью в размере полного изображения до его прихода"""
+        pixmap = QPixmap(file_path)
+        if pixmap.isNull() or full_size.isEmpty():
+            return False
+        self._drop()
+        self.map_item.load_preview(file_path, full_size, pixmap)
+        self._reset_scene()
+        return True
+    
+    def load_tiled(self, full_size: QSizeF, tile_size: int, levels: int):
+        """Фон, который приходит тайлами видимой области"""
+        if full_size.isEmpty():
+            return False
+        self._drop()
+        self.map_item.load_tiled(full_size, tile_size, levels)
+        self._reset_scene()
+        return True
+    
+    def set_active(self, active: bool):
+        """Неактивная карта отпускает полный фон и оставляет миниатюру"""
+        if self.active == active:
+            return
+        self.active = active
+        if active:
+            if (file_path := self._dormant) is not None:
+                self.load_map(file_path, self.map_item.boundingRect().size())
+            return
+        if self._digest is not None and (entry := self.loader.pixmaps.get(self._digest)) is not None:
+            file_path, full_size = self.map_item.file_path, self.map_item.boundingRect().size()
+            self._drop()
+            self.map_item.set_image(entry.thumbnail, full_size, preview=True)
+            self._dormant = file_path
+    
+    def _show(self, file_path, full_size: QSizeF, digest: str):
+        self.map_item.file_path = Path(file_path)
+        if self.active:
+            self._digest = digest
+            self.map_item.set_image(self.loader.pixmaps.acquire(digest), full_size)
+        else:
+            self.map_item.set_image(self.loader.pixmaps.get(digest).thumbnail, full_size, preview=True)
+            self._dormant = Path(file_path)
+    
+    def _on_loaded(self, file_path, full_size: QSizeF, digest: str):
+        # Колбэк отменённой загрузки сюда не приходит
+        self._ticket = None
+        if not digest:
+            return
+        self._show(file_path, full_size, digest)
+        self.scene.setSceneRect(self.map_item.boundingRect())
+        self.scene.update()
+    
+    def _drop(self):
+        """Отменить загрузку и отпустить фон в кеше"""
+        if self._ticket is not None:
+            self.loader.cancel(self._ticket)
+            self._ticket = None
+        self.loader.pixmaps.release(self._digest)
+        self._digest = None
+        self._dormant = None
+    
+    def level(self) -> int:
+        """Уровень тайлов под текущий масштаб"""
+        return self.map_item.level_for(self.zoom_level)
+    
+    def _reset_scene(self):
+        # clear() удалил бы и саму карту
+        if self.map_item.scene() is self.scene:
+            self.scene.removeItem(self.map_item)
+        self.scene.clear()
+        self.scene.addItem(self.map_item)
+        self.scene.setSceneRect(self.map_item.boundingRect())
+        self.updateGridRender()
+        self.fit_to_view()
     
     def updateGridRender(self):
         if self.map_item is None:
@@ -65,6 +178,7 @@ class ViewController:
         if self.map_item:
             self.view.fitInView(self.map_item, Qt.KeepAspectRatio)
             self.zoom_level = self.view.transform().m11()
+            self.on_view_changed()
     
     def zoom_in(self):
         """Увеличивает масштаб"""
@@ -85,6 +199,7 @@ class ViewController:
         """Применяет текущий уровень масштабирования"""
         self.view.resetTransform()
         self.view.scale(self.zoom_level, self.zoom_level)
+        self.on_view_changed()
     
     def wheelEvent(self, event: QWheelEvent):
         """Обработка колесика мыши для масштабирования"""
@@ -81,6 +81,8 @@ class BaseToken(QGraphicsEllipseItem):
     def mouseReleaseEvent(self, event):
         """Привязка к сетке при отпускании"""
         super().mouseReleaseEvent(event)
+        if self.scene():
+            self.scene().item_released.emit(self)
     
     def mousePressEvent(self, event):
         self.animation.stop()
@@ -1,14 +1,26 @@
+import math
+import time
+from collections import OrderedDict
 from typing import Optional
 from pathlib import Path
 
-from PySide6.QtCore import QPoint
-from PySide6.QtGui import QColor, QPen, QPixmap, QMovie
-from PySide6.QtWidgets import QGraphicsPixmapItem
+from PySide6.QtCore import QPoint, QPointF, QRectF, QSizeF
+from PySide6.QtGui import QColor, QPen, QPixmap, QMovie, QPainter, QPainterPath
+from PySide6.QtWidgets import QGraphicsPixmapItem, QGraphicsItem, QStyleOptionGraphicsItem
 
 
 class MapWithGridItem(QGraphicsPixmapItem):
+    # Тайлов в памяти, не считая самого грубого уровня
+    MAX_TILES = 192
+    # Тайл, не пришедший за это время, запрашивается снова, с
+    TILE_TIMEOUT = 3.0
+    # Заливка места под фон, пока он декодируется
+    PLACEHOLDER_COLOR = QColor("#2b2b2b")
+    
     def __init__(self):
         super().__init__(QPixmap())
+        # exposedRect - только перерисовываемая часть: рисуем лишь её тайлы
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
         
         self.file_path: Optional[Path] = None
         self.movie = QMovie()
@@ -18,14 +30,141 @@ class MapWithGridItem(QGraphicsPixmapItem):
         self.grid_visible = True
         self.offset_grid = QPoint(0, 0)
         self.grid_color = QColor("#4a4a4a")
+        # Размер фона на сцене, если изображение меньше (превью, уменьшенное, тайлы);
+        # пустой - изображение в свой размер
+        self.full_size = QSizeF()
+        # Показано превью, полное изображение ещё придёт
+        self.preview = False
+        
+        # Фон тайлами: уровень 0 - оригинал, каждый следующий вдвое меньше
+        self.tile_size = 0
+        self.levels = 0
+        self.tiles: OrderedDict[tuple[int, int, int], QPixmap] = OrderedDict()
+        # Запрошенные тайлы и время запроса
+        self.requested: dict[tuple[int, int, int], float] = {}
+    
+    @property
+    def is_preview(self):
+        return self.preview
+    
+    @property
+    def is_scaled(self):
+        return not self.full_size.isEmpty()
+    
+    @property
+    def is_tiled(self):
+        return self.tile_size > 0
     
     def load(self, file_path):
         self.file_path = Path(file_path)
+        self.preview = False
+        self._setFullSize(QSizeF())
+        self._resetTiles()
         match self.file_path.suffix.lower():
-            case ".png" | ".jpg":
-                self._loadStatic()
             case ".gif":
                 self._loadDynamic()
+            case _:
+                # .png, .jpg, .webp: формат Qt определяет по содержимому
+                self._loadStatic()
+    
+    def set_image(self, pixmap: QPixmap, full_size: QSizeF = QSizeF(), preview=False):
+        """Статичное изображение, растянутое до full_size (пустой - в свой размер).
+        
+        Превью и уменьшенные копии рисуются в размере полного изображения,
+        поэтому координаты токенов не меняются при замене на оригинал.
+        """
+        self.movie.stop()
+        self._resetTiles()
+        self.preview = preview
+        same = full_size.isEmpty() or full_size.toSize() == pixmap.size()
+        self._setFullSize(QSizeF() if same else QSizeF(full_size))
+        self.setPixmap(pixmap)
+    
+    def load_preview(self, file_path, full_size: QSizeF, pixmap: Optional[QPixmap] = None):
+        self.file_path = Path(file_path)
+        self.set_image(pixmap if pixmap is not None else QPixmap(self.file_path), full_size, preview=True)
+    
+    def load_placeholder(self, file_path, full_size: QSizeF):
+        """Место под фон, пока он декодируется"""
+        self.file_path = Path(file_path)
+        self.set_image(QPixmap(), full_size)
+    
+    def load_tiled(self, full_size: QSizeF, tile_size: int, levels: int):
+        """Фон без изображения: тайлы добавляются по мере прихода"""
+        self.file_path = None
+        self.movie.stop()
+        self.preview = False
+        self._resetTiles()
+        self.tile_size = tile_size
+        self.levels = levels
+        self._setFullSize(QSizeF(full_size))
+        self.setPixmap(QPixmap())
+    
+    def level_for(self, scale: float) -> int:
+        """Уровень, у которого пиксель тайла не мельче пикселя экрана"""
+        level = math.floor(math.log2(1 / scale)) if 0 < scale < 1 else 0
+        return min(max(level, 0), self.levels - 1)
+    
+    def tiles_in(self, rect: QRectF, level: int) -> list[tuple[int, int]]:
+        step = self.tile_size << level
+        rect = rect.intersected(self.boundingRect())
+        if rect.isEmpty():
+            return []
+        cols = range(int(rect.left() // step), math.ceil(rect.right() / step))
+        rows = range(int(rect.top() // step), math.ceil(rect.bottom() / step))
+        return [(col, row) for row in rows for col in cols]
+    
+    def missing_tiles(self, rect: QRectF, level: int) -> list[tuple[int, int]]:
+        """Тайлы области, которых нет и которые не ждут ответа; отмечаются запрошенными.
+        
+        Запрос без ответа дольше TILE_TIMEOUT (кадр потерян, у сервера нет тайла) повторяется.
+        """
+        now = time.monotonic()
+        self.requested = {key: asked for key, asked in self.requested.items() if now - asked < self.TILE_TIMEOUT}
+        missing = []
+        for col, row in self.tiles_in(rect, level):
+            key = (level, col, row)
+            if key not in self.tiles and key not in self.requested:
+                self.requested[key] = now
+                missing.append((col, row))
+        return missing
+    
+    def add_tile(self, level: int, col: int, row: int, data: bytes) -> bool:
+        key = (level, col, row)
+        # Битый тайл тоже снимается с ожидания: следующий запрос повторит его
+        self.requested.pop(key, None)
+        pixmap = QPixmap()
+        if not self.is_tiled or not pixmap.loadFromData(data):
+            return False
+        self.tiles[key] = pixmap
+        self.tiles.move_to_end(key)
+        self._evictTiles()
+        self.update(self._tileRect(level, col, row, pixmap))
+        return True
+    
+    def _tileRect(self, level: int, col: int, row: int, pixmap: QPixmap) -> QRectF:
+        step = self.tile_size << level
+        return QRectF(col * step, row * step, pixmap.width() << level, pixmap.height() << level)
+    
+    def _evictTiles(self):
+        coarse = self.levels - 1
+        extra = len(self.tiles) - self.MAX_TILES
+        for key in list(self.tiles):
+            if extra <= 0:
+                break
+            if key[0] != coarse:
+                del self.tiles[key]
+                extra -= 1
+    
+    def _resetTiles(self):
+        self.tile_size = 0
+        self.levels = 0
+        self.tiles.clear()
+        self.requested.clear()
+    
+    def _setFullSize(self, size: QSizeF):
+        self.prepareGeometryChange()
+        self.full_size = size
     
     def _loadStatic(self):
         self.setPixmap(QPixmap(self.file_path))
@@ -41,6 +180,9 @@ class MapWithGridItem(QGraphicsPixmapItem):
             self.setPixmap(frame)
     
     def clear(self):
+        self.preview = False
+        self._setFullSize(QSizeF())
+        self._resetTiles()
         self.setPixmap(QPixmap())
         self.movie.stop()
         self.movie.setFileName("")
@@ -66,12 +208,46 @@ class MapWithGridItem(QGraphicsPixmapItem):
         self.grid_color = QColor(color)
         self.update()
     
-    def paint(self, painter, option, widget=None):
+    def boundingRect(self):
+        if self.is_scaled:
+            return QRectF(QPointF(0, 0), self.full_size)
+        return super().boundingRect()
+    
+    def shape(self):
+        if not self.is_scaled:
+            return super().shape()
+        path = QPainterPath()
+        path.addRect(self.boundingRect())
+        return path
+    
+    def paint(self, painter, option: QStyleOptionGraphicsItem, widget=None):
         """Отрисовка карты и сетки"""
-        super().paint(painter, option, widget)
+        if self.is_scaled:
+            painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+            if not self.pixmap().isNull():
+                painter.drawPixmap(self.boundingRect(), self.pixmap(), QRectF(self.pixmap().rect()))
+            elif not self.is_tiled:
+                painter.fillRect(self.boundingRect(), self.PLACEHOLDER_COLOR)
+            if self.is_tiled:
+                self._draw_tiles(painter, option)
+        else:
+            super().paint(painter, option, widget)
         if self.grid_visible:
             self._draw_grid(painter)
     
+    def _draw_tiles(self, painter, option: QStyleOptionGraphicsItem):
+        """От грубого уровня к нужному: пока точного тайла нет, виден грубый.
+        
+        Нарисованные тайлы становятся самыми свежими: вытесняются те, что ушли с экрана.
+        """
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        for level in range(self.levels - 1, self.level_for(scale) - 1, -1):
+            for col, row in self.tiles_in(option.exposedRect, level):
+                key = (level, col, row)
+                if (pixmap := self.tiles.get(key)) is not None:
+                    self.tiles.move_to_end(key)
+                    painter.drawPixmap(self._tileRect(level, col, row, pixmap), pixmap, QRectF(pixmap.rect()))
+    
     def _draw_grid(self, painter):
         """Отрисовка сетки поверх карты"""
         painter.setPen(QPen(self.grid_color, 2))
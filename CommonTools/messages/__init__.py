@@ -1,4 +1,5 @@
-from .core import BaseMessage
+from .core import BaseMessage, BaseActionType
+from .codec import *
 from .common import *
 from .clients import *
 from .maps import *
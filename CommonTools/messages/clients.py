@@ -1,8 +1,11 @@
+from pydantic import Field
+
 from .core import BaseMessage, BaseActionType
 
 
 class ClientActionType(BaseActionType):
     CONNECT = "client", "connect", "data"
+    SELECT_CODEC = "client", "codec", "data"
     
     START_PLAYER = "client", "start", "player"
     ADD_PLAYER = "client", "add", "player"
@@ -11,6 +14,13 @@ class ClientActionType(BaseActionType):
 
 class ClientConnect(BaseMessage, type=ClientActionType.CONNECT):
     uid: str
+    codecs: list[str] = Field(default_factory=list)
+    features: list[str] = Field(default_factory=list)
+
+
+class ClientSelectCodec(BaseMessage, type=ClientActionType.SELECT_CODEC):
+    codec: str
+    features: list[str] = Field(default_factory=list)
 
 
 class ClientStartPlayer(BaseMessage, type=ClientActionType.START_PLAYER):
@@ -29,6 +39,6 @@ class ClientRemovePlayer(BaseMessage, type=ClientActionType.REMOVE_PLAYER):
 
 
 __all__ = ["ClientActionType",
-           "ClientConnect",
+           "ClientConnect", "ClientSelectCodec",
            "ClientStartPlayer", "ClientAddPlayer", "ClientRemovePlayer"
            ]
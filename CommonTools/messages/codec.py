@@ -0,0 +1,119 @@
+import json
+from typing import Any, ClassVar, Optional
+
+import json5
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec:
+    """Базовый кодек кадров: словарь сообщения <-> текст/байты"""
+    
+    name: ClassVar[str] = ""
+    binary: ClassVar[bool] = False
+    
+    def encode(self, data: dict[str, Any]) -> str | bytes:
+        raise NotImplementedError
+    
+    def decode(self, frame: str | bytes) -> dict[str, Any]:
+        raise NotImplementedError
+    
+    def __repr__(self):
+        return f"<Codec {self.name}>"
+
+
+class Json5Codec(Codec):
+    """Исходный формат: медленный, но его понимают все старые клиенты"""
+    name = "json5"
+    
+    def encode(self, data):
+        return json5.dumps(data, ensure_ascii=False)
+    
+    def decode(self, frame):
+        return json5.loads(frame)
+
+
+class JsonCodec(Codec):
+    """Строгий JSON через стандартный C-парсер"""
+    name = "json"
+    
+    def encode(self, data):
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    
+    def decode(self, frame):
+        return json.loads(frame)
+
+
+class MsgpackCodec(Codec):
+    """Компактные бинарные кадры (нужен пакет msgpack)"""
+    name = "msgpack"
+    binary = True
+    
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+    
+    def decode(self, frame):
+        return msgpack.unpackb(frame, raw=False)
+
+
+LEGACY_CODEC = Json5Codec()
+JSON_CODEC = JsonCodec()
+
+# Порядок = приоритет при согласовании
+CODECS: dict[str, Codec] = {}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+CODECS[JSON_CODEC.name] = JSON_CODEC
+CODECS[LEGACY_CODEC.name] = LEGACY_CODEC
+
+
+# Необязательные возможности протокола, согласуемые вместе с кодеком
+BINARY_IMAGES = "binary_images"
+RESUMABLE_IMAGES = "resumable_images"
+FEATURES: list[str] = [BINARY_IMAGES, RESUMABLE_IMAGES]
+
+
+def available_codecs() -> list[str]:
+    """Имена кодеков, доступных в этом процессе, по убыванию приоритета"""
+    return list(CODECS.keys())
+
+
+def get_codec(name: str) -> Optional[Codec]:
+    return CODECS.get(name)
+
+
+def negotiate_codec(offered: list[str]) -> Codec:
+    """Выбрать лучший общий кодек из предложенных собеседником"""
+    for name, codec in CODECS.items():
+        if name in offered:
+            return codec
+    return LEGACY_CODEC
+
+
+def negotiate_features(offered: list[str]) -> frozenset[str]:
+    """Возможности, которые поддерживают обе стороны"""
+    return frozenset(feature for feature in FEATURES if feature in offered)
+
+
+def decode_frame(frame: str | bytes) -> dict[str, Any]:
+    """Разобрать входящий кадр независимо от согласованного кодека.
+    
+    Бинарные кадры — msgpack, текстовые — строгий JSON с откатом на json5,
+    поэтому кадры, отправленные до смены кодека, тоже читаются.
+    """
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        if msgpack is None:
+            raise ValueError("Binary frame received but msgpack is not installed")
+        return msgpack.unpackb(frame, raw=False)
+    try:
+        return json.loads(frame)
+    except ValueError:
+        return json5.loads(frame)
+
+
+__all__ = ["Codec", "Json5Codec", "JsonCodec", "MsgpackCodec",
+           "LEGACY_CODEC", "JSON_CODEC", "CODECS", "BINARY_IMAGES", "RESUMABLE_IMAGES", "FEATURES",
+           "available_codecs", "get_codec", "negotiate_codec", "negotiate_features", "decode_frame"]
@@ -1,3 +1,5 @@
+from typing import Any, Iterable
+
 from .core import BaseActionType, BaseMessage
 
 
@@ -6,6 +8,7 @@ class CommonActionType(BaseActionType):
     DONE_CALL = ("common", "done", "callback")
     ERROR_CALL = ("common", "error", "callback")
     IGNORE_CALL = ("common", "ignore", "callback")
+    BATCH = ("common", "batch", "data")
 
 
 class ErrorMessage(BaseMessage, type=CommonActionType.ERROR):
@@ -25,8 +28,21 @@ class IgnoreCallback(BaseMessage, type=CommonActionType.IGNORE_CALL):
     uid_callback: str
 
 
+class BatchMessage(BaseMessage, type=CommonActionType.BATCH):
+    """Упорядоченный набор сообщений в одном кадре"""
+    messages: list[dict[str, Any]]
+    
+    @classmethod
+    def pack(cls, messages: Iterable[BaseMessage], trusted=False, **fields):
+        return cls(messages=[msg.to_dict(trusted) for msg in messages], **fields)
+    
+    def unpack(self) -> list[BaseMessage]:
+        return [BaseMessage.from_dict(data) for data in self.messages]
+
+
 __all__ = [
     "CommonActionType",
     "ErrorMessage", "ErrorCallback",
-    "IgnoreCallback", "DoneCallback"
+    "IgnoreCallback", "DoneCallback",
+    "BatchMessage"
 ]
@@ -1,8 +1,9 @@
-from typing import ClassVar, Type, Any, Self
+from typing import ClassVar, Type, Any, Self, Annotated, Optional, Union
 from enum import Enum
 
-import json5
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter, Tag, Discriminator
+
+from .codec import decode_frame
 
 
 class SerializableMixin:
@@ -15,9 +16,16 @@ class SerializableMixin:
         super().__init_subclass__()
         SerializableMixin._type_registry[cls.__qualname__] = cls
     
-    def to_dict(self) -> dict[str, Any]:
-        """Сериализация в словарь с тегом типа"""
-        if isinstance(self, BaseModel):
+    # Общий декодер по всему реестру, строится лениво и кешируется
+    _decoder: ClassVar[Optional[TypeAdapter]] = None
+    _decoder_size: ClassVar[int] = 0
+    
+    def to_dict(self, trusted=False) -> dict[str, Any]:
+        """Сериализация в словарь с тегом типа.
+        
+        trusted=True копирует поля как есть, без прохода сериализатора pydantic.
+        """
+        if isinstance(self, BaseModel) and not trusted:
             data = self.model_dump()
         else:
             data = {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
@@ -25,26 +33,37 @@ class SerializableMixin:
         data['_type'] = self.__class__.__qualname__
         return data
     
+    @staticmethod
+    def _type_tag(data: Any) -> Optional[str]:
+        if isinstance(data, dict):
+            return data.get('_type')
+        return type(data).__qualname__
+    
+    @classmethod
+    def decoder(cls) -> TypeAdapter:
+        """Размеченное объединение всех моделей реестра с ключом '_type'"""
+        registry = SerializableMixin._type_registry
+        if SerializableMixin._decoder is None or SerializableMixin._decoder_size != len(registry):
+            members = tuple(Annotated[target, Tag(name)] for name, target in registry.items()
+                            if issubclass(target, BaseModel))
+            SerializableMixin._decoder = TypeAdapter(
+                Annotated[Union[members], Discriminator(SerializableMixin._type_tag)])
+            SerializableMixin._decoder_size = len(registry)
+        return SerializableMixin._decoder
+    
     @classmethod
     def from_dict(cls, data: dict[str, Any]) -> Self:
-        """Десериализация из словаря по тегу типа"""
-        type_name = data.get('_type')
-        target_cls = cls._type_registry.get(type_name)
-        if not target_cls:
-            print(type_name, cls._type_registry)
-            raise ValueError(f"Unknown type: {type_name}")
-        
-        # Удаляем тег перед созданием объекта
-        data_without_tag = {k: v for k, v in data.items() if k != '_type'}
+        """Десериализация из словаря по тегу типа.
         
-        if issubclass(target_cls, BaseModel):
-            return target_cls.model_validate(data_without_tag)
-        else:
-            return target_cls(**data_without_tag)
+        Класс выбирает само объединение, отдельного поиска по реестру нет.
+        Тег не вырезается: модели игнорируют лишние ключи. Неизвестный тег -
+        ValidationError (наследник ValueError).
+        """
+        return cls.decoder().validate_python(data)
     
     @classmethod
-    def from_str(cls, data: str) -> Self:
-        request = json5.loads(data)
+    def from_str(cls, data: str | bytes) -> Self:
+        request = decode_frame(data)
         return cls.from_dict(request)
 
 
@@ -84,7 +103,13 @@ class NotActionType(BaseActionType):
 
 class BaseMessage(BaseModel, SerializableMixin):
     type: ClassVar[BaseActionType]
+    # Крупная полезная нагрузка: идёт отдельной полосой после управляющих
+    bulk: ClassVar[bool] = False
     
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         cls.type = kwargs.get("type", NotActionType.NOT_TYPE)
+    
+    def coalesce_key(self) -> tuple:
+        """Ключ сущности: более позднее сообщение с тем же ключом заменяет раннее"""
+        return (self.type,)
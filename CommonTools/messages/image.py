@@ -1,3 +1,7 @@
+import struct
+from enum import IntEnum
+from typing import ClassVar
+
 from pydantic import Field
 
 from .core import BaseMessage, BaseActionType
@@ -12,6 +16,16 @@ class ImageActionType(BaseActionType):
     SEND_CHUNK_START = "image", "chunk", "start"
     SEND_CHUNK = "image", "chunk", "data"
     SEND_CHUNK_END = "image", "chunk", "end"
+    
+    SEND_CHUNK_RAW = "image", "chunk", "raw"
+    
+    CHUNK_ACK = "image", "chunk", "ack"
+    CHUNK_CANCEL = "image", "chunk", "cancel"
+    RESUME_REQUEST = "image", "resume", "request"
+    
+    TILE_INFO = "image", "tile", "info"
+    TILE_REQUEST = "image", "tile", "request"
+    SEND_TILE = "image", "tile", "data"
 
 
 class ImageMessage(BaseMessage):
@@ -23,22 +37,36 @@ class ImageNameRequest(ImageMessage, type=ImageActionType.NAME_REQUEST):
 
 
 class ImageSendDirect(ImageMessage, type=ImageActionType.SEND_DIRECT):
+    bulk: ClassVar[bool] = True
+    
     name: str
     size: int
     data: str
     suffix: str
+    # >= 0: байты придут бинарным кадром этого потока, data пустая
+    stream: int = Field(-1)
+    # Картинка уменьшена при сжатии: размер исходника, в котором её показывать
+    full_size: tuple[int, int] = Field((0, 0))
 
 
 class ImageSendCompress(ImageMessage, type=ImageActionType.SEND_COMPRESS):
+    bulk: ClassVar[bool] = True
+    
     name: str
     osize: int
     csize: int
     quality: int
     data: str = Field(repr=False)
     suffix: str
+    stream: int = Field(-1)
+    # Превью: размер полного изображения, которое придёт следом; (0, 0) - само изображение
+    preview_of: tuple[int, int] = Field((0, 0))
+    full_size: tuple[int, int] = Field((0, 0))
 
 
 class ImageMessageChunk(ImageMessage):
+    bulk: ClassVar[bool] = True
+    
     session_id: str
 
 
@@ -49,6 +77,8 @@ class ImageSendChunkStart(ImageMessageChunk, type=ImageActionType.SEND_CHUNK_STA
     quality: int
     chunk_size: int
     suffix: str
+    stream: int = Field(-1)
+    full_size: tuple[int, int] = Field((0, 0))
 
 
 class ImageSendChunk(ImageMessageChunk, type=ImageActionType.SEND_CHUNK):
@@ -60,10 +90,115 @@ class ImageSendChunkEnd(ImageMessageChunk, type=ImageActionType.SEND_CHUNK_END):
     pass
 
 
+class ImageChunkAck(ImageMessageChunk, type=ImageActionType.CHUNK_ACK):
+    bulk: ClassVar[bool] = False
+    
+    received: int
+    complete: bool = Field(False)
+
+
+class ImageChunkCancel(ImageMessageChunk, type=ImageActionType.CHUNK_CANCEL):
+    bulk: ClassVar[bool] = False
+
+
+class ImageResumeRequest(ImageMessageChunk, type=ImageActionType.RESUME_REQUEST):
+    bulk: ClassVar[bool] = False
+    
+    missing: list[int]
+
+
+class ImageTileInfo(ImageMessage, type=ImageActionType.TILE_INFO):
+    """Фон отдаётся тайлами по запросу: размеры пирамиды"""
+    name: str
+    width: int
+    height: int
+    tile_size: int
+    levels: int
+    # >= 0: тайлы придут бинарными кадрами этого потока, иначе - ImageSendTile
+    stream: int = Field(-1)
+
+
+class ImageTileRequest(ImageMessage, type=ImageActionType.TILE_REQUEST):
+    name: str
+    level: int
+    # (столбец, строка)
+    tiles: list[tuple[int, int]]
+
+
+class ImageSendTile(ImageMessage, type=ImageActionType.SEND_TILE):
+    bulk: ClassVar[bool] = True
+    
+    name: str
+    level: int
+    col: int
+    row: int
+    data: str = Field(repr=False)
+
+
+class ImageFrameKind(IntEnum):
+    DIRECT = 0
+    COMPRESS = 1
+    CHUNK = 2
+    TILE = 3
+
+
+class ImageFrame:
+    """Бинарный кадр с байтами изображения без base64.
+    
+    Заголовок: маркер 0xC1 (в msgpack не встречается), вид, поток, номер куска.
+    Поток связывает кадр с управляющим сообщением, которое пришло до него.
+    """
+    type = ImageActionType.SEND_CHUNK_RAW
+    bulk = True
+    
+    MAGIC = 0xC1
+    HEADER = struct.Struct(">BBII")
+    
+    __slots__ = ("kind", "stream", "index", "payload")
+    
+    def __init__(self, kind: ImageFrameKind, stream: int, index: int, payload: memoryview):
+        self.kind = kind
+        self.stream = stream
+        self.index = index
+        self.payload = payload
+    
+    def __repr__(self):
+        return f"<ImageFrame {self.kind.name} stream={self.stream} index={self.index} size={len(self.payload)}>"
+    
+    @classmethod
+    def is_frame(cls, frame) -> bool:
+        return (isinstance(frame, (bytes, bytearray, memoryview))
+                and len(frame) >= cls.HEADER.size and frame[0] == cls.MAGIC)
+    
+    @classmethod
+    def parse(cls, frame: bytes | bytearray | memoryview) -> "ImageFrame":
+        view = memoryview(frame)
+        _, kind, stream, index = cls.HEADER.unpack_from(view)
+        return cls(ImageFrameKind(kind), stream, index, view[cls.HEADER.size:])
+    
+    @classmethod
+    def build(cls, kind: ImageFrameKind, stream: int, index: int, payload: bytes | memoryview) -> bytes:
+        return b"".join((cls.HEADER.pack(cls.MAGIC, kind, stream, index), payload))
+    
+    @staticmethod
+    def tile_index(level: int, col: int, row: int) -> int:
+        """Номер кадра тайла: 6 бит уровня, по 13 бит строки и столбца"""
+        return level << 26 | row << 13 | col
+    
+    def tile(self) -> tuple[int, int, int]:
+        """(уровень, столбец, строка) кадра TILE"""
+        return self.index >> 26, self.index & 0x1FFF, self.index >> 13 & 0x1FFF
+
+
 __all__ = ["ImageActionType",
            
            "ImageNameRequest",
            
            "ImageSendDirect", "ImageSendCompress",
            
-           "ImageSendChunkStart", "ImageSendChunk", "ImageSendChunkEnd"]
+           "ImageSendChunkStart", "ImageSendChunk", "ImageSendChunkEnd",
+           "ImageChunkAck", "ImageChunkCancel", "ImageResumeRequest",
+           
+           "ImageTileInfo", "ImageTileRequest", "ImageSendTile",
+           
+           "ImageFrameKind", "ImageFrame"]
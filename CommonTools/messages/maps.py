@@ -1,10 +1,13 @@
 from .core import BaseMessage, BaseActionType
+from .common import BatchMessage
 
 from pydantic import Field
 
 
 class MapActionType(BaseActionType):
     MAPS_ALL_DATA = "map", "maps", "data"
+    STATE_SNAPSHOT = "map", "state", "snapshot"
+    STATE_DELTA = "map", "state", "delta"
     PLAYER_FREEZE = "map", "player", "freeze"
     PLAYER_MOVED = "map", "player", "move"
     
@@ -22,17 +25,36 @@ class MapActionType(BaseActionType):
 
 
 class GetAllMaps(BaseMessage, type=MapActionType.MAPS_ALL_DATA):
-    pass
+    version: int = Field(-1)
+    # Запуск сервера, к которому относится version
+    epoch: str = Field("")
+
+
+class MapStateSnapshot(BatchMessage, type=MapActionType.STATE_SNAPSHOT):
+    """Полное состояние стола на момент version"""
+    version: int
+    epoch: str = Field("")
+
+
+class MapStateDelta(BatchMessage, type=MapActionType.STATE_DELTA):
+    """Изменения после известной клиенту версии до version"""
+    version: int
+    epoch: str = Field("")
 
 
 class MapPlayerMoved(BaseMessage, type=MapActionType.PLAYER_MOVED):
     uid: str
     pos: tuple[float, float]
+    
+    def coalesce_key(self) -> tuple:
+        return self.type, self.uid
 
 
 class MapLoadBackground(BaseMessage, type=MapActionType.LOAD_BACKGROUND):
     name: str
     uid: str = Field("")
+    # SHA-256 исходного файла: клиент с таким файлом в кеше не качает фон
+    hash: str = Field("")
 
 
 class MapCreateMap(BaseMessage, type=MapActionType.MAP_CREATE):
@@ -51,6 +73,9 @@ class MapActiveMap(BaseMessage, type=MapActionType.MAP_ACTIVE):
 class MapMessageToken(BaseMessage):
     name: str
     mime: str
+    
+    def coalesce_key(self) -> tuple:
+        return self.type, self.name, self.mime
 
 
 class MapAddToken(MapMessageToken, type=MapActionType.ADD_TOKEN):
@@ -87,5 +112,6 @@ __all__ = ["MapActionType",
            
            "MapCreateMap", "MapDeleteMap", "MapActiveMap",
            "MapMovedMap",  "GetAllMaps",
+           "MapStateSnapshot", "MapStateDelta",
            
            "MapAddToken", "MapRemoveToken", "MapMoveToken",  "MapPlayerMoved"]
@@ -1,5 +1,6 @@
-from abc import ABCMeta, ABC, abstractmethod
-from typing import Any
+from abc import ABCMeta, ABC
+from functools import partial
+from typing import Any, Callable
 
 from PySide6.QtWidgets import QMainWindow, QWidget, QVBoxLayout
 from PySide6.QtCore import QObject
@@ -26,6 +27,7 @@ class BaseController(QMainWindow, ABC, metaclass=MetaQABC):
         self.players: dict[str, ClientData] = {}
         
         self.tabMaps = TabMapsWidget(client)
+        self.tabMaps.tokens_restored.connect(self._handle_tokens_restored)
         self.cw = QWidget()
         self.main_box = QVBoxLayout(self.cw)
         self.setCentralWidget(self.cw)
@@ -42,6 +44,10 @@ class BaseController(QMainWindow, ABC, metaclass=MetaQABC):
             "npcs": True,
             "spawn_point": True
         }
+        
+        for action, handler in self.message_routes().items():
+            self.socket.dispatcher.register(action, partial(self._dispatch_active, handler), "controller")
+        self.socket.dispatcher.add_batch_scope(self.tabMaps.suspend_updates)
     
     def clear_buffer(self, name_active):
         self.activeMaps.append(name_active)
@@ -56,6 +62,11 @@ class BaseController(QMainWindow, ABC, metaclass=MetaQABC):
         for uid in removed:
             del self.buffer_tokens[uid]
     
+    def _handle_tokens_restored(self, name, tokens: list[BaseToken]):
+        for token in tokens:
+            self._apply_visible_token(token)
+        self.update_players()
+    
     def _apply_visible_token(self, token: BaseToken):
         match getattr(token, 'ttype', None):
             case "player":
@@ -93,19 +104,17 @@ class BaseController(QMainWindow, ABC, metaclass=MetaQABC):
                 cd = self.players[player_id]
                 self.players_map[player_id] = map_main.create_player(cd.name, cd.cls, player_id)
     
-    # noinspection PyTypeChecker
-    def handle_message(self, msg: BaseMessage):
-        if not self.active:
-            return
-        match msg.type:
-            case MapActionType.ADD_TOKEN:
-                return self._handle_add_token(msg)
-            case MapActionType.REMOVE_TOKEN:
-                return self._handle_remove_token(msg)
-            case MapActionType.MOVE_TOKEN:
-                return self._handle_move_token(msg)
-            case _:
-                return self._handle_custom_message(msg)
+    def message_routes(self) -> dict[BaseActionType, Callable]:
+        """Маршруты контроллера; наследники дополняют своими"""
+        return {
+            MapActionType.ADD_TOKEN: self._handle_add_token,
+            MapActionType.REMOVE_TOKEN: self._handle_remove_token,
+            MapActionType.MOVE_TOKEN: self._handle_move_token,
+        }
+    
+    def _dispatch_active(self, handler, msg: BaseMessage):
+        if self.active:
+            return handler(msg)
     
     def _handle_add_token(self, msg: MapAddToken):
         self.add_token(msg.name, msg.mime, msg.pos)
@@ -119,10 +128,6 @@ class BaseController(QMainWindow, ABC, metaclass=MetaQABC):
         self.move_token(msg.name, msg.mime, msg.pos)
         return True
     
-    @abstractmethod
-    def _handle_custom_message(self, msg: BaseMessage):
-        pass
-    
     def add_token(self, name, mime, pos):
         if self.bufferActive and (name not in self.activeMaps):
             self.buffer_tokens[f"{name}|{mime}"] = pos
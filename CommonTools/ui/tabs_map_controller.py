@@ -1,9 +1,10 @@
+from contextlib import contextmanager
 from functools import partial
-from typing import Any
+from typing import Any, Optional
 from copy import copy
 
-from PySide6.QtWidgets import QTabWidget
-from PySide6.QtCore import Signal, QPointF
+from PySide6.QtWidgets import QTabWidget, QWidget, QVBoxLayout
+from PySide6.QtCore import Signal, QPointF, QSizeF
 
 from CommonTools.map_widget import MapWidget
 from CommonTools.core.client_data import ClientData
@@ -15,8 +16,12 @@ class TabMapsWidget(QTabWidget):
     token_added = Signal(str, object)
     token_removed = Signal(str, object)
     token_moved = Signal(str, object, tuple)
+    token_released = Signal(str, object, tuple)
     
     token_moved_map = Signal(str, object, str)
+    tiles_needed = Signal(str, int, list)
+    # Виджет карты создан, отложенные токены восстановлены
+    tokens_restored = Signal(str, list)
     
     def __init__(self, client):
         super().__init__()
@@ -32,59 +37,155 @@ class TabMapsWidget(QTabWidget):
         
         self.calls_saved: dict[str, tuple[Any, ...]] = {}
         self.visible_always = False
+        # Последняя активированная карта
+        self.active_name: Optional[str] = None
         
+        # Виджет карты создаётся при первом выборе вкладки; полный фон держит
+        # только выбранная, остальные - миниатюру
+        self.currentChanged.connect(self._on_current_changed)
+        
+    def _built(self):
+        return [mdata.mWidget for mdata in self.maps.values() if mdata.is_built]
+    
     def clearMaps(self):
         for name, mData in self.maps.items():
-            mData.mWidget.clear()
+            if mData.is_built:
+                mData.mWidget.clear()
+            mData.tokens.clear()
+            mData.background = mData.background_path = None
+    
+    @contextmanager
+    def suspend_updates(self):
+        """Отложить перерисовку всех карт до конца блока"""
+        widgets = self._built()
+        for mWidget in widgets:
+            mWidget.setUpdatesEnabled(False)
+        try:
+            yield
+        finally:
+            # Карты могли удалить/добавить/создать внутри блока
+            for mWidget in self._built():
+                mWidget.setUpdatesEnabled(True)
+                mWidget.viewport().update()
     
     def addMap(self, name, visible=True):
+        """Вкладка получает пустую страницу; MapWidget создаётся при первом показе"""
         if self.maps.get(name, None) is None:
-            mWidget = MapWidget(self.client)
-            mWidget.set_token_movement([k for k, v in self.movement_settings.items() if v], True)
-            mWidget.set_token_movement([k for k, v in self.movement_settings.items() if not v], False)
-            mWidget.token_added.connect(partial(self.token_added.emit, name))
-            mWidget.token_removed.connect(partial(self.token_removed.emit, name))
-            mWidget.token_moved.connect(partial(self.token_moved.emit, name))
-            mWidget.token_moved_map.connect(partial(self.token_moved_map.emit, name))
-            
-            for fname, args in self.calls_saved.items():
-                impl = getattr(mWidget, fname, None)
-                if impl is None:
-                    continue
-                impl(*args)
-            idx = self.addTab(mWidget, name)
+            page = QWidget()
+            QVBoxLayout(page).setContentsMargins(0, 0, 0, 0)
+            # До addTab: первая вкладка сразу становится текущей и строится
+            self.maps[name] = MapData(name, visible, page)
+            idx = self.addTab(page, name)
             self.setTabVisible(idx, visible or self.visible_always)
-            self.maps[name] = MapData(name, visible, mWidget)
             return True
     
+    def _build(self, mdata: MapData) -> MapWidget:
+        """Создать виджет карты и применить накопленное состояние за один проход"""
+        name = mdata.name
+        mWidget = MapWidget(self.client)
+        mWidget.setUpdatesEnabled(False)
+        mWidget.set_token_movement([k for k, v in self.movement_settings.items() if v], True)
+        mWidget.set_token_movement([k for k, v in self.movement_settings.items() if not v], False)
+        mWidget.tiles_needed.connect(partial(self.tiles_needed.emit, name))
+        
+        for fname, args in self.calls_saved.items():
+            impl = getattr(mWidget, fname, None)
+            if impl is None:
+                continue
+            impl(*args)
+        # Фон раньше токенов: загрузка фона очищает сцену
+        if mdata.background is not None:
+            fname, args = mdata.background
+            getattr(mWidget, fname)(*args)
+        tokens = [token for mime, pos in mdata.tokens.items()
+                  if (token := mWidget.create_token(mime, QPointF(*pos))) is not None]
+        
+        # Восстановленные токены - не новые: сигналы подключаются после них
+        mWidget.token_added.connect(partial(self.token_added.emit, name))
+        mWidget.token_removed.connect(partial(self.token_removed.emit, name))
+        mWidget.token_moved.connect(partial(self.token_moved.emit, name))
+        mWidget.token_released.connect(partial(self.token_released.emit, name))
+        mWidget.token_moved_map.connect(partial(self.token_moved_map.emit, name))
+        
+        mdata.page.layout().addWidget(mWidget)
+        mdata.mWidget = mWidget
+        mdata.tokens.clear()
+        mdata.background = mdata.background_path = None
+        mWidget.setUpdatesEnabled(True)
+        self.tokens_restored.emit(name, tokens)
+        return mWidget
+    
     def removeMap(self, name):
-        if mWidget := self.getMap(name):
-            self.removeTab(self.indexOf(mWidget))
+        if mdata := self.maps.get(name, None):
             del self.maps[name]
+            if self.active_name == name:
+                self.active_name = None
+            self.removeTab(self.indexOf(mdata.page))
+            if mdata.is_built:
+                # Отпустить фон в общем кеше
+                mdata.mWidget.view_controller.clear()
             return True
             
     def activeMap(self, name):
-        if mWidget := self.getMap(name):
-            self.maps[name].visible = True
-            self.setTabVisible(self.indexOf(mWidget), self.maps[name].visible)
+        if mdata := self.maps.get(name, None):
+            self.active_name = name
+            mdata.visible = True
+            self.setTabVisible(self.indexOf(mdata.page), mdata.visible)
+            if mdata.is_built:
+                mdata.mWidget.set_active(True)
             return True
     
-    def getMapData(self, name) -> tuple[MapData, list[BaseToken]]:
+    def _on_current_changed(self, index):
+        current = self.widget(index)
+        for mdata in list(self.maps.values()):
+            if mdata.page is current and not mdata.is_built:
+                self._build(mdata)
+            if mdata.is_built:
+                mdata.mWidget.set_active(mdata.page is current)
+    
+    def getMapData(self, name) -> tuple[MapData, list[tuple[str, tuple[float, float]]]]:
+        """Карта и её токены (mime, позиция), в том числе ещё не созданные"""
         mdata = self.maps[name]
-        return mdata, [item for item in mdata.mWidget.items() if isinstance(item, BaseToken)]
+        if not mdata.is_built:
+            return mdata, list(mdata.tokens.items())
+        return mdata, [(token.mime(), token.pos().toTuple())
+                       for token in mdata.mWidget.token_manager.tokens.values()]
     
     def getOffsetSize(self):
         return copy(self.calls_saved["setOffsetSize"])
     
-    def load_map(self, name, file_path):
-        self.maps[name].mWidget.load_map(file_path)
+    def _load(self, name, fname, *args, file_path=None):
+        """Фон карты без виджета запоминается и загрузится при её создании"""
+        if (mdata := self.maps.get(name, None)) is None:
+            return None
+        if mdata.is_built:
+            return getattr(mdata.mWidget, fname)(*args)
+        mdata.background = fname, args
+        mdata.background_path = file_path
+        return True
+    
+    def load_map(self, name, file_path, full_size: tuple[int, int] = (0, 0)):
+        """full_size - размер исходника, если пришла уменьшенная копия"""
+        self._load(name, "load_map", file_path, QSizeF(*full_size), file_path=file_path)
+    
+    def load_preview(self, name, file_path, full_size: tuple[int, int]):
+        self._load(name, "load_preview", file_path, QSizeF(*full_size), file_path=file_path)
+    
+    def load_tiled(self, name, full_size: tuple[int, int], tile_size: int, levels: int, file_path=None):
+        return self._load(name, "load_tiled", QSizeF(*full_size), tile_size, levels, file_path, file_path=file_path)
+    
+    def add_tile(self, name, level: int, col: int, row: int, data: bytes):
+        # Тайлы запрашивает только созданный виджет
+        if mWidget := self.getMap(name):
+            return mWidget.add_tile(level, col, row, data)
     
     def getActiveNameMap(self):
         if not self.maps:
             return None
         return list(self.maps.keys())[self.currentIndex()]
     
-    def getMap(self, name) -> MapWidget:
+    def getMap(self, name) -> Optional[MapWidget]:
+        """Виджет карты; None - карты нет или она ещё не показывалась"""
         mdata = self.maps.get(name, None)
         if mdata:
             return mdata.mWidget
@@ -94,34 +195,44 @@ class TabMapsWidget(QTabWidget):
     
     # noinspection PyArgumentList
     def create_token(self, name: str, mime: str, pos: tuple[float, float]):
-        point = QPointF(*pos)
-        mWidget = self.getMap(name)
-        if mWidget is None:
+        """None, если карты нет или токен отложен до создания её виджета"""
+        mdata = self.maps.get(name, None)
+        if mdata is None:
+            return
+        if not mdata.is_built:
+            mdata.tokens[mime] = pos
             return
-        return mWidget.create_token(mime, point)
+        return mdata.mWidget.create_token(mime, QPointF(*pos))
     
     def removeTokenByMime(self, name: str, mime: str):
-        mWidget = self.getMap(name)
-        if mWidget is None:
+        mdata = self.maps.get(name, None)
+        if mdata is None:
+            return
+        if not mdata.is_built:
+            mdata.tokens.pop(mime, None)
             return
-        mWidget.remove_token(mime)
+        mdata.mWidget.remove_token(mime)
     
     def removeToken(self, token: BaseToken):
-        for mdata in self.maps.values():
-            if token in mdata.mWidget.items():
-                mdata.mWidget.remove_token(token.mime())
+        for mWidget in self._built():
+            if token in mWidget.items():
+                mWidget.remove_token(token.mime())
                 return
     
     def move_token(self, name, mime, pos):
-        mWidget = self.getMap(name)
-        if mWidget is None:
+        mdata = self.maps.get(name, None)
+        if mdata is None:
+            return
+        if not mdata.is_built:
+            if mime in mdata.tokens:
+                mdata.tokens[mime] = pos
             return
-        mWidget.setTokenMimePos(mime, pos)
+        mdata.mWidget.setTokenMimePos(mime, pos)
     
     def call_all_method(self, name, *args):
+        """Созданным картам - сразу, остальным - при создании"""
         self.calls_saved[name] = args
-        for mdata in self.maps.values():
-            mWidget = mdata.mWidget
+        for mWidget in self._built():
             impl = getattr(mWidget, name, None)
             if impl is None:
                 print(f"Function for {mWidget} not find {name}")
@@ -133,12 +244,14 @@ class TabMapsWidget(QTabWidget):
             if token_type in self.movement_settings:
                 self.movement_settings[token_type] = enabled
         
-        for mdata in self.maps.values():
-            mdata.mWidget.set_token_movement([k for k, v in self.movement_settings.items() if v], True)
-            mdata.mWidget.set_token_movement([k for k, v in self.movement_settings.items() if not v], False)
+        for mWidget in self._built():
+            mWidget.set_token_movement([k for k, v in self.movement_settings.items() if v], True)
+            mWidget.set_token_movement([k for k, v in self.movement_settings.items() if not v], False)
     
     def items(self, fname=None):
         for name, mdata in self.maps.items():
+            if not mdata.is_built:
+                continue
             for item in mdata.mWidget.items():
                 if isinstance(item, BaseToken):
                     yield name, item
@@ -1 +1,2 @@
-from .image_utils import compress_image_to_base64
+from .image_utils import (file_digest, encode_image, adaptive_encode, EncodeResult,
+                          build_pyramid, load_pyramid, trim_pyramids, pyramid_levels, TilePyramid)
@@ -1,31 +1,236 @@
-import base64
+import hashlib
 import io
+import json
+import math
+import os
+import shutil
+import time
 from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
 
-from PIL import Image
+from PIL import Image, features
 from loguru import logger
 logger = logger.bind(module="UTILS")
 
 
-def compress_image_to_base64(image_path, quality=75, max_width=1200):
-    """Сжатие изображения в base64"""
+def file_digest(path) -> str:
+    """SHA-256 содержимого файла; для больших фонов - в пуле процессов"""
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+class EncodeResult(NamedTuple):
+    data: bytes
+    suffix: str
+    # 100 - без потерь (исходный файл или PNG с палитрой)
+    quality: int
+    # Время кодирования, с
+    seconds: float
+    # Размер исходного изображения, если картинка уменьшена (превью или не влезла в бюджет)
+    size: tuple[int, int] = (0, 0)
+
+
+# Картинки с малым числом цветов уходят без потерь палитрой
+PALETTE_COLORS = 256
+
+
+def has_alpha(img: Image.Image) -> bool:
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        return img.convert("RGBA").getchannel("A").getextrema()[0] < 255
+    return False
+
+
+def choose_format(img: Image.Image) -> str:
+    """PNG с палитрой для рисованных карт, WebP (JPEG без него) для фото и рендеров"""
+    if img.getcolors(PALETTE_COLORS) is not None:
+        return "PNG"
+    if features.check("webp"):
+        return "WEBP"
+    # JPEG теряет прозрачность, палитра её сохраняет
+    return "PNG" if has_alpha(img) else "JPEG"
+
+
+def _save(img: Image.Image, fmt: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    match fmt:
+        case "PNG":
+            if img.mode not in ("P", "L", "1"):
+                img = img.convert("RGBA").quantize(PALETTE_COLORS, Image.Quantize.FASTOCTREE) \
+                    if has_alpha(img) else img.convert("RGB").quantize(PALETTE_COLORS)
+            img.save(buffer, format="PNG", optimize=True)
+        case "WEBP":
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if has_alpha(img) else "RGB")
+            img.save(buffer, format="WEBP", quality=quality, method=4)
+        case _:
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def _fit_quality(img: Image.Image, fmt: str, budget: int, min_quality: int, max_quality: int) -> tuple[bytes, int]:
+    """Двоичный поиск наибольшего качества, укладывающегося в budget"""
+    best = None
+    low, high = min_quality, max_quality
+    while low <= high:
+        quality = (low + high) // 2
+        data = _save(img, fmt, quality)
+        if len(data) <= budget:
+            best = data, quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best or (_save(img, fmt, min_quality), min_quality)
+
+
+def adaptive_encode(image_path, budget: int, min_quality=40, max_quality=90,
+                    max_side: Optional[int] = None) -> EncodeResult:
+    """Формат по содержимому, качество - под бюджет байт.
+    
+    Картинка уменьшается, только если не влезает и при min_quality,
+    или до max_side по большей стороне (превью).
+    """
+    started = time.perf_counter()
+    full_size = (0, 0)
+    with Image.open(image_path) as img:
+        if max_side:
+            full_size = img.size
+            # JPEG сразу декодируется в уменьшенном масштабе
+            img.draft("RGB", (max_side, max_side))
+            img = img.copy()
+            img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        img.load()
+        fmt = choose_format(img)
+        if fmt == "PNG":
+            data = _save(img, fmt, 100)
+            if len(data) <= budget or not features.check("webp") and has_alpha(img):
+                return EncodeResult(data, ".png", 100, time.perf_counter() - started, full_size)
+            # Палитра не влезла в бюджет - переходим на сжатие с потерями
+            fmt = "WEBP" if features.check("webp") else "JPEG"
+        data, quality = _fit_quality(img, fmt, budget, min_quality, max_quality)
+        if len(data) > budget:
+            scale = math.sqrt(budget / len(data))
+            # Получатель растянет уменьшенную картинку обратно: координаты токенов не съезжают
+            if full_size == (0, 0):
+                full_size = img.size
+            size = max(1, int(img.width * scale)), max(1, int(img.height * scale))
+            data, quality = _fit_quality(img.resize(size, Image.Resampling.LANCZOS), fmt, budget,
+                                         min_quality, max_quality)
+    suffix = ".webp" if fmt == "WEBP" else ".jpg"
+    return EncodeResult(data, suffix, quality, time.perf_counter() - started, full_size)
+
+
+class TilePyramid(NamedTuple):
+    width: int
+    height: int
+    tile_size: int
+    # Уровень 0 - оригинал, каждый следующий вдвое меньше; последний - один тайл
+    levels: int
+    suffix: str
+    # Каталог пирамиды в дисковом кеше
+    root: str
+    
+    def tile_path(self, level: int, col: int, row: int) -> Path:
+        return Path(self.root) / str(level) / f"{col}_{row}{self.suffix}"
+
+
+PYRAMID_MANIFEST = "pyramid.json"
+
+
+def pyramid_levels(width: int, height: int, tile_size: int) -> int:
+    levels = 1
+    while max(width, height) > tile_size << (levels - 1):
+        levels += 1
+    return levels
+
+
+def load_pyramid(root) -> Optional[TilePyramid]:
+    """Готовая пирамида из кеша; None - ещё не построена"""
+    manifest = Path(root) / PYRAMID_MANIFEST
     try:
-        with Image.open(image_path) as img:
-            # Изменяем размер если нужно
-            if max_width and img.width > max_width:
-                ratio = max_width / img.width
-                new_height = int(img.height * ratio)
-                img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Конвертируем в RGB если нужно
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Сохраняем с сжатием
-            buffer = io.BytesIO()
-            img.save(buffer, format="JPEG", quality=quality, optimize=True)
-            return base64.b64encode(buffer.getvalue()).decode('utf-8'), Path(image_path).suffix
+        data = json.loads(manifest.read_text("utf-8"))
+    except (OSError, ValueError):
+        return None
+    os.utime(manifest)
+    return TilePyramid(root=str(root), **data)
+
+
+def build_pyramid(image_path, root, tile_size=512, quality=80) -> TilePyramid:
+    """Тайлы всех уровней в каталог root; выполняется в пуле процессов.
+    
+    Каталог называется по хешу содержимого, поэтому готовая пирамида
+    переиспользуется. Старые пирамиды убирает trim_pyramids.
+    """
+    root = Path(root)
+    if (pyramid := load_pyramid(root)) is not None:
+        return pyramid
+    with Image.open(image_path) as img:
+        img.load()
+        fmt = choose_format(img)
+        width, height = img.size
+        levels = pyramid_levels(width, height, tile_size)
+        pyramid = TilePyramid(width, height, tile_size, levels,
+                              {"WEBP": ".webp", "PNG": ".png"}.get(fmt, ".jpg"), str(root))
+        level_img = img
+        for level in range(levels):
+            if level:
+                size = max(1, math.ceil(width / 2 ** level)), max(1, math.ceil(height / 2 ** level))
+                level_img = level_img.resize(size, Image.Resampling.LANCZOS)
+            (root / str(level)).mkdir(parents=True, exist_ok=True)
+            for row in range(math.ceil(level_img.height / tile_size)):
+                for col in range(math.ceil(level_img.width / tile_size)):
+                    box = (col * tile_size, row * tile_size,
+                           min((col + 1) * tile_size, level_img.width), min((row + 1) * tile_size, level_img.height))
+                    pyramid.tile_path(level, col, row).write_bytes(_save(level_img.crop(box), fmt, quality))
+    # Манифест последним: каталог без него - недостроенная пирамида
+    manifest = root / (PYRAMID_MANIFEST + ".part")
+    manifest.write_text(json.dumps({key: value for key, value in pyramid._asdict().items() if key != "root"}), "utf-8")
+    os.replace(manifest, root / PYRAMID_MANIFEST)
+    return pyramid
+
+
+def trim_pyramids(cache_dir, keep: int, live: Iterable[str] = ()):
+    """Удалить давно не открывавшиеся пирамиды сверх keep; выполняется в пуле процессов.
     
-    except Exception as e:
+    live - каталоги (хеши) пирамид, которые сейчас отдаются или строятся: они
+    не удаляются и в keep не считаются. Каталог без манифеста вне live -
+    остаток прерванного построения, он удаляется всегда.
+    """
+    live = set(live)
+    built = []
+    for root in Path(cache_dir).iterdir():
+        if not root.is_dir() or root.name in live:
+            continue
+        try:
+            built.append(((root / PYRAMID_MANIFEST).stat().st_mtime, root))
+        except OSError:
+            shutil.rmtree(root, ignore_errors=True)
+    built.sort()
+    for _, root in built[:max(0, len(built) - keep)]:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def encode_image(image_path, budget: Optional[int] = None, max_side: Optional[int] = None) -> EncodeResult:
+    """Байты изображения для отправки; выполняется в пуле процессов.
+    
+    budget None или исходник в пределах бюджета - файл как есть: быстрый канал
+    получает оригинал, и он ложится в кеш получателя под своим хешем.
+    max_side - превью с этой большей стороной.
+    """
+    started = time.perf_counter()
+    path = Path(image_path)
+    if max_side:
+        return adaptive_encode(path, budget, max_side=max_side)
+    size = path.stat().st_size
+    if budget is None or size <= budget:
+        return EncodeResult(path.read_bytes(), path.suffix, 100, time.perf_counter() - started)
+    try:
+        result = adaptive_encode(path, budget)
+    except Exception:
         logger.opt(exception=True).error("Ошибка сжатия изображения")
-        raise
\ No newline at end of file
+        raise
+    if len(result.data) >= size:
+        # Исходник уже плотнее - отправляем его без потерь
+        return EncodeResult(path.read_bytes(), path.suffix, 100, time.perf_counter() - started)
+    return result
@@ -1,8 +1,7 @@
-import json5
 import websockets
 from attrs import define, field
 
-from CommonTools.messages import BaseMessage
+from CommonTools.messages import BaseMessage, Codec, LEGACY_CODEC
 
 
 @define
@@ -14,10 +13,11 @@ class ClientContext:
     cls: str = field(default="", init=False)
     is_master: bool = field(default=False, init=False)
     is_player: bool = field(default=False, init=False)
+    codec: Codec = field(default=LEGACY_CODEC, init=False)
     
     async def send_dict(self, data: dict):
-        """Отправка данных в формате JSON"""
-        await self.socket.send(json5.dumps(data, ensure_ascii=False))
+        """Отправка данных согласованным кодеком"""
+        await self.socket.send(self.codec.encode(data))
     
     async def send_msg(self, msg: BaseMessage):
         """Отправка структурированного сообщения"""
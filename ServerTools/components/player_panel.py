@@ -11,6 +11,7 @@ class PlayerItemRole(IntEnum):
     CLASS_ROLE = Qt.ItemDataRole.UserRole
     ACTIVE_ROLE = auto()
     UID_ROLE = auto()
+    QUEUE_ROLE = auto()
 
 
 @define
@@ -19,6 +20,9 @@ class PlayerItem:
     name: str
     cls: str
     active: bool = field(default=False)
+    # Кадров в исходящей очереди и вытеснено обновлений у медленного клиента
+    queue_depth: int = field(default=0)
+    dropped: int = field(default=0)
 
 
 class PlayerPanelModel(QAbstractListModel):
@@ -42,6 +46,8 @@ class PlayerPanelModel(QAbstractListModel):
                 return self._players[index.row()].active
             case PlayerItemRole.UID_ROLE:
                 return self._players[index.row()].uid
+            case PlayerItemRole.QUEUE_ROLE:
+                return self._players[index.row()].queue_depth, self._players[index.row()].dropped
     
     def setData(self, index, value, role=Qt.ItemDataRole.DisplayRole):
         if not index.isValid() or index.row() >= len(self._players):
@@ -79,6 +85,15 @@ class PlayerPanelModel(QAbstractListModel):
         idx = self._players.index(player)
         self.setData(self.createIndex(idx, 0), active, PlayerItemRole.ACTIVE_ROLE)
     
+    def setQueueStats(self, uid: str, depth: int, dropped: int):
+        for i, player in enumerate(self._players):
+            if player.uid == uid:
+                if (player.queue_depth, player.dropped) != (depth, dropped):
+                    player.queue_depth, player.dropped = depth, dropped
+                    index = self.createIndex(i, 0)
+                    self.dataChanged.emit(index, index, [PlayerItemRole.QUEUE_ROLE])
+                return
+    
     def clear(self):
         self.beginResetModel()
         self._players.clear()
@@ -101,6 +116,7 @@ class PlayerPanelDelegate(QStyledItemDelegate):
         player_name = index.data(Qt.ItemDataRole.DisplayRole)
         player_cls = index.data(PlayerItemRole.CLASS_ROLE)
         player_active = index.data(PlayerItemRole.ACTIVE_ROLE)
+        queue_depth, dropped = index.data(PlayerItemRole.QUEUE_ROLE)
         
         checkbox_option = QStyleOptionButton()
         checkbox_option.rect = option.rect.adjusted(0, 14, -option.rect.width() + 48, -14)
@@ -111,6 +127,8 @@ class PlayerPanelDelegate(QStyledItemDelegate):
         text_rect = option.rect.adjusted(50, 0, 0, 0)
         painter.drawText(text_rect, f"Имя: {player_name}", Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft)
         painter.drawText(text_rect, f"Класс: {player_cls}", Qt.AlignmentFlag.AlignBottom | Qt.AlignmentFlag.AlignLeft)
+        painter.drawText(text_rect, f"Очередь: {queue_depth}, пропущено: {dropped}",
+                         Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
         painter.restore()
         
         painter.save()
@@ -181,5 +199,8 @@ class PlayerPanel(QDockWidget):
         self.modelList.removeByUidPlayer(uid)
         self._handle_change_state("")
     
+    def updateQueueStats(self, uid, depth, dropped):
+        self.modelList.setQueueStats(uid, depth, dropped)
+    
     def clear(self):
         self.modelList.clear()
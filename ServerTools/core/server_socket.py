@@ -1,26 +1,43 @@
 import uuid
 from functools import partial
 from contextlib import contextmanager
+from typing import Iterable, Optional
 
 from PySide6.QtCore import Signal
 from PySide6.QtWebSockets import QWebSocketServer
 from PySide6.QtNetwork import QHostAddress
-from PySide6.QtWidgets import QApplication
 
-from CommonTools.core import Socket, ClientData, ImageSender
+from CommonTools.core import Socket, ClientData, ImageSender, SendQueue
 from CommonTools.messages import *
+from .state_journal import StateJournal
+from .tile_server import TileServer
 
 
 class WebSocketServer(Socket):
-    message_received_uid = Signal(str, str)
+    message_received_uid = Signal(str, object)
     client_connected = Signal(str)
     client_disconnected = Signal(str)
     
-    def __init__(self, max_size=10 * 1024 ** 2):
-        super().__init__(None)
+    peer_context = True
+    
+    def __init__(self, max_size=10 * 1024 ** 2, trusted_peers=False, flush_rate: float = 25,
+                 high_water=512 * 1024):
+        super().__init__(None, flush_rate)
         self.clients: dict[str, ClientData] = {}
+        self.trusted_peers = trusted_peers
+        self.state = StateJournal()
         self.server = QWebSocketServer("DndRunner", QWebSocketServer.SslMode.NonSecureMode)
         self.max_size_msg = max_size
+        self.high_water = high_water
+        
+        self.tiles = TileServer(self, self.image_sender.service)
+        self.tiles.error_occurred.connect(self.error_occurred.emit)
+        
+        self.dispatcher.register_many({
+            ClientActionType.SELECT_CODEC: self._handle_select_codec,
+            ClientActionType.START_PLAYER: self._handle_start_player,
+            CommonActionType.BATCH: self._handle_batch,
+        }, "server", context=True)
     
     def start_server(self):
         if self.server.listen(QHostAddress("0.0.0.0"), 8765):
@@ -45,16 +62,20 @@ class WebSocketServer(Socket):
         if socket:
             uid = uuid.uuid4().hex
             self.clients[uid] = ClientData(uid, "", "", socket)
+            self.clients[uid].trusted = self.trusted_peers
+            self.clients[uid].queue = SendQueue(socket, self.high_water)
             
             socket.textMessageReceived.connect(partial(self._handle_message, uid))
+            socket.binaryMessageReceived.connect(partial(self._handle_binary_message, uid))
             socket.disconnected.connect(partial(self._handle_disconnect, uid))
             self.client_connected.emit(uid)
-            self.answer(uid, ClientConnect(uid=uid))
+            self.answer(uid, ClientConnect(uid=uid, codecs=available_codecs(), features=FEATURES))
     
     def send_msg(self, msg: BaseMessage):
-        for uid, client in self.clients.items():
-            QApplication.processEvents()
-            client.send_msg(msg)
+        self.broadcast(msg)
+    
+    def peer_client(self, peer: str) -> Optional[ClientData]:
+        return self.clients.get(peer)
     
     def send_image(self, path, name):
         for uid, client in self.clients.items():
@@ -64,29 +85,80 @@ class WebSocketServer(Socket):
         with self.bind_client(uid):
             self.clients[uid].send_msg(msg)
     
-    def answer_image(self, uid: str, path, name):
+    def sync_client(self, uid: str, known_version: int = -1, epoch: str = ""):
+        """Довести клиента до текущей версии: журнал изменений или общий снимок"""
+        self.outbound.flush()
         client = self.clients[uid]
-        self.image_sender.send_image_socket(path, name, client)
+        deltas = self.state.deltas_since(known_version, epoch)
+        if deltas is None:
+            client.send_frame(self.state.snapshot_frame(client))
+        else:
+            # Пустой журнал тоже отвечается: клиент узнаёт, что его состояние актуально
+            client.send_msg(MapStateDelta.pack(deltas, client.trusted, version=self.state.version,
+                                               epoch=self.state.epoch))
+        client.state_version = self.state.version
     
-    def broadcast(self, msg: BaseMessage, uid_answer=None):
+    def answer_image(self, uid: str, path, name, preview=True):
+        client = self.clients[uid]
+        self.image_sender.send_image_socket(path, name, client, preview)
+    
+    def broadcast(self, msg: BaseMessage, exclude: Iterable[str] = ()):
+        """Рассылка всем, кроме exclude: кадр кодируется один раз на кодек.
+        
+        Изменения состояния уходят только синхронизированным клиентам:
+        остальные получат их в снимке.
+        """
+        self.outbound.flush()
+        is_state = self.state.record(msg)
+        # Медленному клиенту достаточно последнего положения сущности
+        state_key = msg.coalesce_key() if msg.type in self.SUPERSEDABLE else None
+        frames: dict[tuple[str, bool], str | bytes] = {}
         for uid, client in self.clients.items():
-            QApplication.processEvents()
-            if uid_answer and (uid == uid_answer):
+            if uid in exclude:
                 continue
-            client.send_msg(msg)
-    
-    def _handle_message(self, uid: str, message: str):
-        msg = BaseMessage.from_str(message)
-        if not self.image_receiver.handle_message(msg):
-            match msg.type:
-                case ClientActionType.START_PLAYER:
-                    self.clients[uid].name = msg.name
-                    self.clients[uid].cls = msg.cls
-                    self.clients[uid].is_playing = True
-            self.message_received_uid.emit(uid, message)
-            self.message_received.emit(message)
+            if is_state:
+                if client.state_version < 0:
+                    continue
+                client.state_version = self.state.version
+            key = (client.codec.name, client.trusted)
+            if (frame := frames.get(key)) is None:
+                frame = frames[key] = client.encode(msg)
+            client.send_frame(frame, state_key)
+    
+    def queue_stats(self, uid: str) -> tuple[int, int]:
+        """(кадров в очереди, вытеснено обновлений) для клиента"""
+        queue = self.clients[uid].queue
+        return (queue.depth, queue.dropped) if queue else (0, 0)
+    
+    def _handle_binary_message(self, uid: str, message):
+        self._handle_message(uid, message.data())
+    
+    def _handle_message(self, uid: str, message: str | bytes):
+        self.enqueue(message, uid)
+    
+    def deliver(self, msg: BaseMessage, uid: str):
+        self.stats.frame_delivered()
+        self.dispatcher.dispatch(msg, uid)
+        self.message_received_uid.emit(uid, msg)
+        self.message_received.emit(msg)
+    
+    def _handle_batch(self, uid: str, msg: BatchMessage):
+        self.dispatcher.dispatch_batch(msg.unpack(), uid)
+        return True
+    
+    def _handle_select_codec(self, uid: str, msg: ClientSelectCodec):
+        self.clients[uid].codec = negotiate_codec([msg.codec])
+        self.clients[uid].features = negotiate_features(msg.features)
+        return True
+    
+    def _handle_start_player(self, uid: str, msg: ClientStartPlayer):
+        self.clients[uid].name = msg.name
+        self.clients[uid].cls = msg.cls
+        self.clients[uid].is_playing = True
     
     def _handle_disconnect(self, uid: str):
+        # Кадры ушедшего клиента, ещё не разобранные, уже некому применять
+        self.inbound = [item for item in self.inbound if item[0] != (uid,)]
         if uid in self.clients:
             self.clients[uid].socket.deleteLater()
             del self.clients[uid]
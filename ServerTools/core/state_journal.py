@@ -0,0 +1,68 @@
+import uuid
+from collections import deque
+from typing import Callable, Optional
+
+from CommonTools.core import ClientData
+from CommonTools.messages import *
+
+
+class StateJournal:
+    """Версия состояния стола, журнал изменений и кеш закодированного снимка"""
+    
+    STATE_TYPES = frozenset({
+        MapActionType.MAP_CREATE, MapActionType.MAP_DELETE, MapActionType.MAP_ACTIVE,
+        MapActionType.MAP_GRID_DATA, MapActionType.LOAD_BACKGROUND,
+        MapActionType.ADD_TOKEN, MapActionType.REMOVE_TOKEN, MapActionType.MOVE_TOKEN,
+        ClientActionType.ADD_PLAYER, ClientActionType.REMOVE_PLAYER,
+    })
+    
+    def __init__(self, builder: Optional[Callable[[], list[BaseMessage]]] = None, max_deltas=1024):
+        self.version = 0
+        # Версии сравнимы только в пределах одного запуска сервера
+        self.epoch = uuid.uuid4().hex
+        self.builder = builder
+        self.deltas: deque[tuple[int, BaseMessage]] = deque(maxlen=max_deltas)
+        
+        self._snapshot: Optional[MapStateSnapshot] = None
+        self._frames: dict[tuple[str, bool], str | bytes] = {}
+    
+    def is_state(self, msg: BaseMessage) -> bool:
+        return msg.type in self.STATE_TYPES
+    
+    def record(self, msg: BaseMessage) -> bool:
+        """Учесть изменение состояния; возвращает False для прочих сообщений"""
+        if not self.is_state(msg):
+            return False
+        self.version += 1
+        # Подряд идущие перемещения одного токена схлопываются в последнее
+        if (msg.type is MapActionType.MOVE_TOKEN and self.deltas
+                and self.deltas[-1][1].type is MapActionType.MOVE_TOKEN
+                and (self.deltas[-1][1].name, self.deltas[-1][1].mime) == (msg.name, msg.mime)):
+            self.deltas.pop()
+        self.deltas.append((self.version, msg))
+        return True
+    
+    def snapshot(self) -> MapStateSnapshot:
+        """Снимок пересобирается только при смене версии"""
+        if self._snapshot is None or self._snapshot.version != self.version:
+            messages = self.builder() if self.builder else []
+            self._snapshot = MapStateSnapshot.pack(messages, version=self.version, epoch=self.epoch)
+            self._frames.clear()
+        return self._snapshot
+    
+    def snapshot_frame(self, client: ClientData) -> str | bytes:
+        snapshot = self.snapshot()
+        key = (client.codec.name, client.trusted)
+        if (frame := self._frames.get(key)) is None:
+            frame = self._frames[key] = client.encode(snapshot)
+        return frame
+    
+    def deltas_since(self, version: int, epoch: str) -> Optional[list[BaseMessage]]:
+        """Изменения новее version или None, если журнал их уже не хранит"""
+        if epoch != self.epoch or version < 0 or version > self.version:
+            return None
+        if version == self.version:
+            return []
+        if not self.deltas or self.deltas[0][0] > version + 1:
+            return None
+        return [msg for delta_version, msg in self.deltas if delta_version > version]
@@ -0,0 +1,141 @@
+import base64
+import itertools
+from concurrent.futures import Future
+from functools import partial
+from pathlib import Path
+from typing import Callable, Optional
+
+from PySide6.QtCore import QObject, Signal
+from PySide6.QtGui import QImageReader
+
+from CommonTools.core import ImageService, ClientData
+from CommonTools.messages import *
+from CommonTools.utils import build_pyramid, trim_pyramids, pyramid_levels, TilePyramid
+
+
+class TileServer(QObject):
+    """Большие фоны отдаются тайлами: игрок запрашивает только видимые.
+    
+    Пирамида уровней режется в пуле процессов в дисковый кеш по хешу
+    содержимого, повторная загрузка того же фона её переиспользует.
+    Запросы, пришедшие раньше готовности, отвечаются по её завершении.
+    Теми же тайлами рисует фон и сам мастер.
+    """
+    error_occurred = Signal(str)
+    
+    # Большая сторона, начиная с которой фон отдаётся тайлами
+    TILE_FROM = 4096
+    
+    def __init__(self, server, service: ImageService, tile_size=512, cache_dir: Optional[Path] = None,
+                 keep=16):
+        super().__init__()
+        self.server = server
+        self.service = service
+        self.tile_size = tile_size
+        # Каталог пирамид; None - тайлы не строятся
+        self.cache_dir = cache_dir
+        # Сколько неиспользуемых пирамид остаётся в кеше
+        self.keep = keep
+        
+        self.pyramids: dict[str, Future] = {}
+        # Каталог пирамиды фона в кеше - хеш содержимого
+        self.digests: dict[str, str] = {}
+        # Поток бинарных тайлов фона
+        self.streams: dict[str, int] = {}
+        self._stream_ids = itertools.count()
+        
+        self.server.dispatcher.register_many({
+            ImageActionType.TILE_REQUEST: self._handle_request,
+        }, "tiles", context=True)
+    
+    def layout(self, path) -> Optional[tuple[int, int, int]]:
+        """(ширина, высота, уровни) по заголовку файла; None - фон не тайловый"""
+        size = QImageReader(str(path)).size()
+        if self.cache_dir is None or max(size.width(), size.height()) < self.TILE_FROM:
+            return None
+        return size.width(), size.height(), pyramid_levels(size.width(), size.height(), self.tile_size)
+    
+    def prepare(self, name: str, path, digest: str) -> bool:
+        """Начать построение пирамиды, если фон достаточно большой"""
+        self.forget(name)
+        if self.layout(path) is None:
+            return False
+        future = self.pyramids[name] = self.service.submit(build_pyramid, path, self.cache_dir / digest,
+                                                           self.tile_size)
+        self.digests[name] = digest
+        self.streams[name] = next(self._stream_ids) % 2 ** 32
+        # Ошибку построения сообщают ожидающие тайлов
+        self.service.then(future, self._trim)
+        return True
+    
+    def forget(self, name: str):
+        if (future := self.pyramids.pop(name, None)) is not None:
+            self.service.cancel(future)
+        self.digests.pop(name, None)
+        self.streams.pop(name, None)
+    
+    def request_tiles(self, name: str, level: int, tiles: list[tuple[int, int]],
+                      deliver: Callable[[int, int, int, bytes], None]):
+        """deliver(уровень, столбец, строка, байты) для каждого найденного тайла"""
+        if (future := self.pyramids.get(name)) is None:
+            return
+        self.service.then(future, partial(self._deliver, name, future, level, tiles, deliver), self._encode_failed)
+    
+    def answer_info(self, uid: str, name: str) -> bool:
+        """Сообщить игроку размеры пирамиды; False - фон отдаётся целиком"""
+        if (future := self.pyramids.get(name)) is None:
+            return False
+        self.service.then(future, partial(self._send_info, uid, name, future), self._encode_failed)
+        return True
+    
+    def _send_info(self, uid: str, name: str, future: Future, pyramid: TilePyramid):
+        # Пока строилось, фон успели сменить
+        if (client := self.server.peer_client(uid)) is None or self.pyramids.get(name) is not future:
+            return
+        client.send_msg(ImageTileInfo(
+            name=name,
+            width=pyramid.width,
+            height=pyramid.height,
+            tile_size=pyramid.tile_size,
+            levels=pyramid.levels,
+            stream=self.streams[name] if BINARY_IMAGES in client.features else -1
+        ))
+    
+    def _handle_request(self, uid: str, msg: ImageTileRequest):
+        if (client := self.server.peer_client(uid)) is not None:
+            self.request_tiles(msg.name, msg.level, msg.tiles, partial(self._send_tile, client, msg.name))
+        return True
+    
+    def _deliver(self, name: str, future: Future, level: int, tiles: list[tuple[int, int]],
+                 deliver: Callable, pyramid: TilePyramid):
+        if self.pyramids.get(name) is not future:
+            return
+        for col, row in tiles:
+            try:
+                data = pyramid.tile_path(level, col, row).read_bytes()
+            except OSError:
+                continue
+            deliver(level, col, row, data)
+    
+    def _trim(self, _pyramid: TilePyramid):
+        """Чистка кеша после построения: пирамиды открытых фонов не трогаются"""
+        if self.cache_dir is not None:
+            self.service.submit(trim_pyramids, self.cache_dir, self.keep, set(self.digests.values()))
+    
+    def _send_tile(self, client: ClientData, name: str, level: int, col: int, row: int, data: bytes):
+        if name not in self.streams:
+            return
+        if BINARY_IMAGES in client.features:
+            index = ImageFrame.tile_index(level, col, row)
+            client.send_frame(ImageFrame.build(ImageFrameKind.TILE, self.streams[name], index, data), bulk=True)
+            return
+        client.send_msg(ImageSendTile(
+            name=name,
+            level=level,
+            col=col,
+            row=row,
+            data=base64.b64encode(data).decode("utf-8")
+        ))
+    
+    def _encode_failed(self, error: BaseException):
+        self.error_occurred.emit(f"Error: {error}")
@@ -17,11 +17,9 @@ class MasterController(BaseController):
         self.tabMaps.token_added.connect(self._ohandle_add_token)
         self.tabMaps.token_removed.connect(self._ohandle_remove_token)
         self.tabMaps.token_moved.connect(self._ohandle_move_token)
+        self.tabMaps.token_released.connect(self._ohandle_release_token)
         self.tabMaps.token_moved_map.connect(self._ohandle_move_map)
     
-    def _handle_custom_message(self, msg: BaseMessage):
-        return
-    
     def _ohandle_add_token(self, name, token: BaseToken):
         if self.tabMaps.isEmpty():
             return
@@ -36,7 +34,14 @@ class MasterController(BaseController):
     def _ohandle_move_token(self, name, token: BaseToken, pos: tuple[float, float]):
         if self.tabMaps.isEmpty():
             return
-        self.socket.send_msg(MapMoveToken(name=name, mime=token.mime(), pos=pos))
+        self.socket.post(MapMoveToken(name=name, mime=token.mime(), pos=pos))
+    
+    def _ohandle_release_token(self, name, token: BaseToken, pos: tuple[float, float]):
+        # Конечная позиция уходит сразу, не дожидаясь тика
+        if self.tabMaps.isEmpty():
+            return
+        self.socket.post(MapMoveToken(name=name, mime=token.mime(), pos=pos))
+        self.socket.flush()
         
     def _ohandle_move_map(self, from_map, token, to_map):
         pass
@@ -47,12 +52,12 @@ class MasterController(BaseController):
         
     def removeMap(self, name):
         self.tabMaps.removeMap(name)
+        self.socket.tiles.forget(name)
         self.socket.send_msg(MapDeleteMap(name=name))
     
     def removeActiveMap(self):
         self.removeMap(self.tabMaps.getActiveNameMap())
         
     def activeMap(self, name):
-        if self.tabMaps.getMap(name):
-            self.tabMaps.activeMap(name)
+        if self.tabMaps.activeMap(name):
             self.socket.send_msg(MapActiveMap(name=name))
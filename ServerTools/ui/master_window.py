@@ -1,8 +1,9 @@
+from functools import partial
 from pathlib import Path
 from typing import Any
 
-from PySide6.QtCore import Qt, QPoint
-from PySide6.QtWidgets import QMainWindow, QToolBar, QSpinBox, QLabel, QCheckBox, QApplication, QFileDialog
+from PySide6.QtCore import Qt, QPoint, QTimer
+from PySide6.QtWidgets import QMainWindow, QToolBar, QSpinBox, QLabel, QCheckBox, QFileDialog
 from loguru import logger
 
 logger = logger.bind(pack="ServerWindow")
@@ -10,9 +11,9 @@ logger = logger.bind(pack="ServerWindow")
 from CommonTools.components import ColorButton, GuidePanel
 from ServerTools.core.server_socket import WebSocketServer
 from CommonTools.messages import *
-from CommonTools.core import Image, ClientData
+from CommonTools.utils import file_digest
+from CommonTools.core import Image, ClientData, EncodedPayload
 from ServerTools.components import TokensPanel, DialogCreateMap, PlayerPanel
-from CommonTools.map_widget.tokens_dnd import BaseToken
 
 from .masterController import MasterController
 
@@ -24,19 +25,32 @@ class MasterGameTable(QMainWindow):
         self.setWindowTitle("Виртуальный стол: Мастер")
         
         self.images: dict[str, Any] = {}
+        self.image_hashes: dict[str, str] = {}
+        # Выбранный фон, хеш которого ещё считается; до готовности карта остаётся с прежним
+        self.pending_images: dict[str, str] = {}
         self.players: dict[str, ClientData] = {}
         self.server = WebSocketServer()
+        self.server.state.builder = self._build_snapshot
         self.server.client_connected.connect(self._handle_connect)
         self.server.client_disconnected.connect(self._handle_disconnect)
-        self.server.message_received_uid.connect(self._handle_message_raw)
+        self.server.dispatcher.register_many({
+            ClientActionType.START_PLAYER: self._action_add_player,
+            MapActionType.MAPS_ALL_DATA: self._handle_all_data_maps,
+            ImageActionType.NAME_REQUEST: self._handle_name_map,
+        }, "window", context=True)
+        self.server.dispatcher.set_fallback(self._handle_unhandled, "window", context=True)
         self.server.image_received.connect(self._handle_image)
+        self.server.image_sender.payload_encoded.connect(self._handle_payload_encoded)
         
         self.server.start_server()
         
         self.cache_folder = Path("./.cache")
         self.cache_folder.mkdir(exist_ok=True, parents=True)
+        self.server.image_receiver.cache_dir = self.cache_folder
+        self.server.tiles.cache_dir = self.cache_folder / "tiles"
         
         self.controller = MasterController(self.server)
+        self.controller.tabMaps.tiles_needed.connect(self._load_tiles)
         self.setCentralWidget(self.controller)
         
         self.token_panel = TokensPanel()
@@ -50,6 +64,10 @@ class MasterGameTable(QMainWindow):
         self.player_panel.active_change.connect(self._handle_change_freeze)
         self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, self.player_panel)
         
+        self.queue_timer = QTimer(self, interval=1000)
+        self.queue_timer.timeout.connect(self._update_queue_stats)
+        self.queue_timer.start()
+        
         self.topToolBar = QToolBar()
         self.addToolBar(Qt.ToolBarArea.TopToolBarArea, self.topToolBar)
         
@@ -68,8 +86,10 @@ class MasterGameTable(QMainWindow):
         
         self.offset_grid_x = QSpinBox(value=0)
         self.offset_grid_x.valueChanged.connect(self._handle_offset_size_change)
+        self.offset_grid_x.editingFinished.connect(self.server.flush)
         self.offset_grid_y = QSpinBox(value=0)
         self.offset_grid_y.valueChanged.connect(self._handle_offset_size_change)
+        self.offset_grid_y.editingFinished.connect(self.server.flush)
         
         self.bottomToolBar.addWidget(QLabel("Отступ"))
         self.bottomToolBar.addWidget(self.offset_grid_x)
@@ -78,6 +98,7 @@ class MasterGameTable(QMainWindow):
         
         self.size_grid = QSpinBox(value=50)
         self.size_grid.valueChanged.connect(self._handle_offset_size_change)
+        self.size_grid.editingFinished.connect(self.server.flush)
         
         self.bottomToolBar.addWidget(QLabel("Размер сетки"))
         self.bottomToolBar.addWidget(self.size_grid)
@@ -118,9 +139,38 @@ class MasterGameTable(QMainWindow):
         if name := self.controller.tabMaps.getActiveNameMap():
             path, _ = QFileDialog.getOpenFileName(self, "Выберете фон", ".", "Image(*.png *.jpg);;Animation(*.gif)")
             if path:
-                self.images[name] = path
-                self.controller.tabMaps.load_map(name, path)
-                self.server.broadcast(MapLoadBackground(name=name))
+                self.pending_images[name] = path
+                # Хеш большого фона считается секунды: в пуле, рассылка - когда он готов
+                service = self.server.image_sender.service
+                service.then(service.submit(file_digest, path), partial(self._set_background, name, path),
+                             partial(self._background_failed, name, path))
+    
+    def _set_background(self, name: str, path, digest: str):
+        # Пока считался хеш, выбрали другой фон или удалили карту
+        if self.pending_images.get(name) != path:
+            return
+        del self.pending_images[name]
+        if self.controller.tabMaps.maps.get(name) is None:
+            return
+        self.images[name] = path
+        self.image_hashes[name] = digest
+        # Игроки запросят фон сразу после рассылки: большой режем на тайлы, остальные сжимаем заранее
+        if self.server.tiles.prepare(name, path, digest):
+            width, height, levels = self.server.tiles.layout(path)
+            self.controller.tabMaps.load_tiled(name, (width, height), self.server.tiles.tile_size, levels, path)
+        else:
+            self.server.image_sender.prewarm(path, self.server.clients.values())
+            self.controller.tabMaps.load_map(name, path)
+        self.server.broadcast(MapLoadBackground(name=name, hash=digest))
+    
+    def _background_failed(self, name: str, path, error: BaseException):
+        if self.pending_images.get(name) == path:
+            del self.pending_images[name]
+        logger.error("Не удалось прочитать фон {name}: {error}", name=name, error=error)
+    
+    def _load_tiles(self, name: str, level: int, tiles: list):
+        """Мастер рисует большой фон теми же тайлами из дискового кеша"""
+        self.server.tiles.request_tiles(name, level, tiles, partial(self.controller.tabMaps.add_tile, name))
     
     def _on_action_active_map(self):
         if name := self.controller.tabMaps.getActiveNameMap():
@@ -130,11 +180,15 @@ class MasterGameTable(QMainWindow):
         offset = QPoint(self.offset_grid_x.value(), self.offset_grid_y.value())
         size = self.size_grid.value()
         self.controller.tabMaps.call_all_method("setOffsetSize", offset, size)
-        self.server.broadcast(MapGridData(offset=offset.toTuple(), size=size))
+        self.server.post(MapGridData(offset=offset.toTuple(), size=size))
     
     def _handle_change_freeze(self, uid, state):
         logger.debug(f"change freeze {uid=} {state=}")
     
+    def _update_queue_stats(self):
+        for uid in self.players:
+            self.player_panel.updateQueueStats(uid, *self.server.queue_stats(uid))
+    
     def _handle_connect(self, uid):
         logger.success("Клиент подключен с uid: {uid}", uid=uid)
     
@@ -142,66 +196,64 @@ class MasterGameTable(QMainWindow):
         self.players.pop(uid, None)
         self.controller.update_player_list(self.players)
         self.player_panel.removePlayer(uid)
-        self.server.broadcast(ClientRemovePlayer(uid=uid), uid)
+        self.server.broadcast(ClientRemovePlayer(uid=uid), exclude=(uid,))
         logger.success("Клиент отключен с uid: {uid}", uid=uid)
     
-    def _handle_message_raw(self, uid, msg_raw: str):
-        msg = BaseMessage.from_str(msg_raw)
-        self._handle_message(uid, msg)
-    
-    def _handle_message(self, uid, msg: BaseMessage):
-        if self.controller.handle_message(msg):
-            return
-        match msg.type:
-            case ClientActionType.START_PLAYER:
-                self._action_add_player(uid, msg)
-            case MapActionType.MAPS_ALL_DATA:
-                self._handle_all_data_maps(uid, msg)
-            case ImageActionType.NAME_REQUEST:
-                self._handle_name_map(uid, msg)
-            case _:
-                logger.info("Не обработанное сообщение: {mtype} - {msg}", mtype=msg.type, msg=msg)
+    def _handle_unhandled(self, uid, msg: BaseMessage):
+        logger.info("Не обработанное сообщение: {mtype} - {msg}", mtype=msg.type, msg=msg)
     
     def _handle_image(self, image: Image):
-        cache_image = self.cache_folder / f"{image.name}{image.suffix}"
-        cache_image.write_bytes(image.image_data)
+        if image.file_path is None:
+            cache_image = self.cache_folder / f"{image.name}{image.suffix}"
+            cache_image.write_bytes(image.image_data)
         logger.debug("Получено изображение {iname}{isuffix} через {istrategy}", iname=image.name,
                      isuffix=image.suffix, istrategy=image.strategy)
     
+    def _handle_payload_encoded(self, name: str, payload: EncodedPayload):
+        logger.debug("Фон {iname}: {isize} байт {isuffix}, качество {iquality}, кодирование {iseconds:.2f} с",
+                     iname=name, isize=len(payload.data), isuffix=payload.suffix,
+                     iquality=payload.quality, iseconds=payload.seconds)
+    
     def _action_add_player(self, uid_answer: str, msg: ClientStartPlayer):
         self.server.answer(uid_answer, msg)
-        self.server.broadcast(ClientAddPlayer(uid=uid_answer, name=msg.name, cls=msg.cls), uid_answer)
-        for uid, client in self.server.clients.items():
-            QApplication.processEvents()
-            if client.is_playing and uid_answer != uid:
-                self.server.answer(uid_answer, ClientAddPlayer(uid=uid, name=client.name, cls=client.cls))
+        self.server.broadcast(ClientAddPlayer(uid=uid_answer, name=msg.name, cls=msg.cls), exclude=(uid_answer,))
         self.players[uid_answer] = self.server.clients[uid_answer]
         self.controller.update_player_list(self.players)
         self.player_panel.addPlayer(uid_answer, msg.name, msg.cls)
+        return True
     
     def closeEvent(self, event):
         self.server.stop_server()
+        self.server.image_sender.service.shutdown()
         return super().closeEvent(event)
     
-    def _handle_all_data_maps(self, uid, _):
+    def _handle_all_data_maps(self, uid, msg: GetAllMaps):
+        self.server.sync_client(uid, msg.version, msg.epoch)
+        return True
+    
+    def _build_snapshot(self) -> list[BaseMessage]:
+        """Состояние стола для снимка: сетка, игроки, карты, фоны и токены"""
         offset: QPoint
         offset, size = self.controller.tabMaps.getOffsetSize()
-        self.server.answer(uid, MapChangeGridOffset(offset=offset.toTuple(), size=size))
+        messages: list[BaseMessage] = [MapGridData(offset=offset.toTuple(), size=size)]
+        messages.extend(ClientAddPlayer(uid=uid, name=client.name, cls=client.cls)
+                        for uid, client in self.server.clients.items() if client.is_playing)
         for map_name in self.controller.tabMaps.maps.keys():
-            QApplication.processEvents()
             mdata, tokens = self.controller.tabMaps.getMapData(map_name)
             
-            self.server.answer(uid, MapCreateMap(name=mdata.name, visible=mdata.visible))
-            if mdata.mWidget.file_map:
-                self.server.answer(uid, MapLoadBackground(name=map_name))
-            for item in mdata.mWidget.items():
-                QApplication.processEvents()
-                if isinstance(item, BaseToken):
-                    self.server.answer(uid, MapAddToken(name=map_name, mime=item.mime(), pos=item.pos().toTuple()))
+            messages.append(MapCreateMap(name=mdata.name, visible=mdata.visible))
+            if mdata.file_map:
+                messages.append(MapLoadBackground(name=map_name, hash=self.image_hashes.get(map_name, "")))
+            messages.extend(MapAddToken(name=map_name, mime=mime, pos=pos) for mime, pos in tokens)
+        if (active := self.controller.tabMaps.active_name) is not None:
+            messages.append(MapActiveMap(name=active))
+        return messages
     
     def _handle_name_map(self, uid, msg: ImageNameRequest):
         if file_path := self.images.get(msg.name, None):
             self.server.answer(uid, DoneCallback(uid_callback=msg.uid))
-            self.server.answer_image(uid, file_path, msg.name)
+            if not self.server.tiles.answer_info(uid, msg.name):
+                self.server.answer_image(uid, file_path, msg.name)
         else:
             self.server.answer(uid, IgnoreCallback(uid_callback=msg.uid))
+        return True
@@ -0,0 +1,38 @@
+"""Размер кадра и время кодирования/декодирования для каждого сообщения.
+
+Запуск из корня проекта: python -m benchmarks.bench_codec
+"""
+import timeit
+
+from CommonTools.messages import CODECS, BaseMessage, decode_frame
+from .samples import message_classes, sample_message
+
+
+def bench_message(msg: BaseMessage, number: int):
+    data = msg.to_dict()
+    row = {}
+    for name, codec in CODECS.items():
+        frame = codec.encode(data)
+        size = len(frame.encode("utf-8")) if isinstance(frame, str) else len(frame)
+        encode_us = timeit.timeit(lambda: codec.encode(msg.to_dict()), number=number) / number * 1e6
+        decode_us = timeit.timeit(lambda: BaseMessage.from_dict(decode_frame(frame)), number=number) / number * 1e6
+        row[name] = (size, encode_us, decode_us)
+    return row
+
+
+def main(number=200):
+    names = list(CODECS.keys())
+    header = f"{'message':<22}" + "".join(f"| {name:^30}" for name in names)
+    print(header)
+    print(f"{'':<22}" + "".join(f"| {'bytes':>8} {'enc µs':>10} {'dec µs':>10}" for _ in names))
+    print("-" * len(header))
+    for cls in sorted(message_classes(), key=lambda c: c.__qualname__):
+        # Тяжёлые сообщения с картинками гоняем реже
+        n = max(number // 20, 5) if "data" in cls.model_fields else number
+        row = bench_message(sample_message(cls), n)
+        print(f"{cls.__qualname__:<22}" + "".join(
+            f"| {size:>8} {enc:>10.1f} {dec:>10.1f}" for size, enc, dec in row.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Разбор словаря в сообщение: старый путь против размеченного объединения.
+
+Запуск из корня проекта: python -m benchmarks.bench_decoder
+"""
+import timeit
+
+from pydantic import BaseModel
+
+from CommonTools.messages import BaseMessage, MapMoveToken, ImageSendChunk
+from CommonTools.messages.core import SerializableMixin
+from .samples import sample_message
+
+
+def legacy_from_dict(data):
+    """Поиск класса по __qualname__, копия словаря без тега и model_validate"""
+    target_cls = SerializableMixin._type_registry[data["_type"]]
+    data_without_tag = {k: v for k, v in data.items() if k != "_type"}
+    if issubclass(target_cls, BaseModel):
+        return target_cls.model_validate(data_without_tag)
+    return target_cls(**data_without_tag)
+
+
+def main(number=20_000):
+    BaseMessage.decoder()  # построение адаптера не входит в замер
+    for cls in (MapMoveToken, ImageSendChunk):
+        msg = sample_message(cls)
+        data = msg.to_dict()
+        n = number if cls is MapMoveToken else number // 20
+        cases = {
+            "legacy from_dict": lambda: legacy_from_dict(data),
+            "union from_dict": lambda: BaseMessage.from_dict(data),
+            "to_dict": lambda: msg.to_dict(),
+            "trusted to_dict": lambda: msg.to_dict(trusted=True),
+        }
+        print(cls.__qualname__)
+        for name, func in cases.items():
+            us = timeit.timeit(func, number=n) / n * 1e6
+            print(f"    {name:<20} {us:>8.2f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Синтетический шторм перемещений токена через серверный сокет.
+
+Сравнивает старую схему (сокет и окно разбирают кадр каждый сам) с
+передачей готового объекта пачкой, где перекрытые перемещения
+отбрасываются, и печатает счётчики FrameStats.
+
+Запуск из корня проекта: python -m benchmarks.bench_move_storm
+"""
+import sys
+import time
+
+from PySide6.QtCore import QCoreApplication
+
+from CommonTools.messages import BaseMessage, MapMoveToken, JSON_CODEC, LEGACY_CODEC
+from ServerTools.core.server_socket import WebSocketServer
+
+
+def make_frames(codec, count):
+    return [codec.encode(MapMoveToken(name="main", mime="mob:Гоблин:3", pos=(i * 0.5, i * 0.25)).to_dict())
+            for i in range(count)]
+
+
+def legacy_pipeline(frames):
+    started = time.perf_counter()
+    for frame in frames:
+        msg = BaseMessage.from_str(frame)
+        msg.type  # сокет смотрит на тип
+        BaseMessage.from_str(frame)  # окно разбирает строку повторно
+    return time.perf_counter() - started
+
+
+def typed_pipeline(server: WebSocketServer, frames):
+    received = []
+    server.message_received_uid.connect(lambda uid, msg: received.append(msg))
+    server.stats.reset()
+    started = time.perf_counter()
+    for frame in frames:
+        server._handle_message("bench", frame)
+    server.drain_inbound()
+    elapsed = time.perf_counter() - started
+    assert len(received) + server.stats.superseded == len(frames)
+    return elapsed
+
+
+def main(count=20_000):
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    for codec in (LEGACY_CODEC, JSON_CODEC):
+        frames = make_frames(codec, count)
+        server = WebSocketServer()
+        legacy = legacy_pipeline(frames)
+        typed = typed_pipeline(server, frames)
+        decoded_rate, saved_rate = server.stats.rates()
+        print(f"[{codec.name}] {count} moves: legacy {legacy * 1e3:.1f} ms, typed {typed * 1e3:.1f} ms")
+        print(f"    decoded={server.stats.decoded} saved={server.stats.decodes_saved} "
+              f"superseded={server.stats.superseded} "
+              f"({decoded_rate:,.0f} decodes/s, {saved_rate:,.0f} decodes saved/s)")
+    return app
+
+
+if __name__ == "__main__":
+    main()
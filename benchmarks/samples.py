@@ -0,0 +1,45 @@
+"""Генерация типовых экземпляров всех сообщений для бенчмарков"""
+import typing
+from typing import Any
+
+from CommonTools.messages import BaseMessage
+from CommonTools.messages.core import SerializableMixin, NotActionType
+
+CHUNK_PAYLOAD = 64 * 1024
+
+
+def _sample_value(name: str, annotation: Any) -> Any:
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin is tuple:
+        return tuple(_sample_value(name, arg) for arg in args)
+    if origin is list:
+        return [_sample_value(name, args[0])] if args else []
+    if origin is dict:
+        return {}
+    if annotation is bool:
+        return True
+    if annotation is int:
+        return 42
+    if annotation is float:
+        return 123.5
+    if annotation is str:
+        if name == "data":
+            return "A" * CHUNK_PAYLOAD
+        if name == "mime":
+            return "player:Гимли:Воин:6f1c2a9e0b7d4c55"
+        return "value_" + name
+    return None
+
+
+def message_classes() -> list[type[BaseMessage]]:
+    """Все конкретные сообщения из реестра сериализации"""
+    return [cls for cls in SerializableMixin._type_registry.values()
+            if isinstance(cls, type) and issubclass(cls, BaseMessage)
+            and cls.type is not NotActionType.NOT_TYPE]
+
+
+def sample_message(cls: type[BaseMessage]) -> BaseMessage:
+    values = {name: _sample_value(name, info.annotation)
+              for name, info in cls.model_fields.items()}
+    return cls(**values)
@@ -1,4 +1,5 @@
 import sys
+import multiprocessing
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning, module='pkg_resources')
 
@@ -16,6 +17,8 @@ import assets_rc
 import log
 
 if __name__ == "__main__":
+    # Пул обработки изображений запускает копии приложения
+    multiprocessing.freeze_support()
     with PrintManager() as pm:
         pm.show_caller_info(True)
         QApplication.setApplicationName("Dnd Table")